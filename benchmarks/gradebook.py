@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Generator for synthetic Blackboard gradebooks, used by the benchmarks.
+
+The gradebook contains one nested archive per student and attempt, named in the
+same way as a Blackboard download (``Task_<studentnr>_attempt_<timestamp>_<name>``),
+together with the ``.txt`` submission receipts and a matching grade column CSV.
+Nested ``rar`` archives are created as solid archives with the ``rar`` command,
+which must be installed. Run it directly to create a gradebook for manual testing::
+
+    python benchmarks/gradebook.py --students 600 --formats zip,tar.gz --output /tmp/gradebook
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import subprocess
+import tarfile
+import tempfile
+
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+FORMATS = ('zip', 'tar.gz', 'tar.bz2', 'rar')
+EXTENSIONS = ('.html', '.css', '.js', '.php')
+
+
+def _content(rng, size):
+    """Create ``size`` bytes of compressible source-code-like text."""
+    words = [b'function', b'return', b'<div class="x">', b'</div>', b'color: red;', b'$value', b'= 1;', b'\n']
+    data = bytearray()
+    while len(data) < size:
+        data.extend(rng.choice(words))
+        data.extend(b' ')
+    return bytes(data[:size])
+
+
+def _nested_zip(files):
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as out_f:
+        for name, data in files:
+            out_f.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _nested_tar(files, mode):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as out_f:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            out_f.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def _nested_rar(files):
+    with tempfile.TemporaryDirectory(prefix='automarking-rar-') as directory:
+        for name, data in files:
+            path = os.path.join(directory, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as out_f:
+                out_f.write(data)
+        subprocess.check_call(['rar', 'a', '-s', '-idq', 'nested.rar'] + [name for name, _ in files], cwd=directory)
+        with open(os.path.join(directory, 'nested.rar'), 'rb') as in_f:
+            return in_f.read()
+
+
+def nested_archive(format_, files):
+    """Create a nested archive in the ``format_`` (``zip``, ``tar.gz``, ``tar.bz2`` or ``rar``)
+    containing the (name, data) ``files``."""
+    if format_ == 'zip':
+        return _nested_zip(files)
+    elif format_ == 'tar.gz':
+        return _nested_tar(files, 'w:gz')
+    elif format_ == 'tar.bz2':
+        return _nested_tar(files, 'w:bz2')
+    elif format_ == 'rar':
+        return _nested_rar(files)
+    raise ValueError('Unsupported format %s' % format_)
+
+
+def generate(directory, students=100, formats=('zip',), members=6, member_size=4096, attempts=1,
+             nested_fraction=0.3, task_id='task_01', compression=ZIP_STORED, seed=1):
+    """Generate a gradebook ``gradebook.zip`` and grade column ``gradecolumn.csv`` in ``directory``.
+
+    :param students: The number of students
+    :param formats: The nested archive formats, used in turn for the students
+    :param members: The number of files in each nested archive
+    :param member_size: The average size of the files in bytes
+    :param attempts: The number of attempts per student
+    :param nested_fraction: The fraction of submissions whose files are in an extra directory
+                            named after the ``task_id``, which ``GradeBookFix.fix_zips`` flattens
+    :param compression: The compression used for the gradebook itself. Blackboard stores the
+                        nested archives uncompressed.
+    :return: The paths of the gradebook and the grade column and the list of student numbers
+    :rtype: ``tuple``
+    """
+    rng = random.Random(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    gradebook = os.path.join(directory, 'gradebook.zip')
+    gradecolumn = os.path.join(directory, 'gradecolumn.csv')
+    studentnrs = ['%08i' % (20000000 + index) for index in range(students)]
+    with ZipFile(gradebook, 'w', compression) as out_f:
+        for index, studentnr in enumerate(studentnrs):
+            format_ = formats[index % len(formats)]
+            for attempt in range(attempts):
+                timestamp = '2023-01-%02i-%02i-00-00' % (1 + attempt, 9 + index % 12)
+                prefix = '%s/' % task_id if rng.random() < nested_fraction else ''
+                files = []
+                for member in range(members):
+                    size = max(1, int(rng.gauss(member_size, member_size / 4)))
+                    files.append(('%s%s_%i%s' % (prefix, task_id, member, EXTENSIONS[member % len(EXTENSIONS)]),
+                                  _content(rng, size)))
+                name = 'Task_%s_attempt_%s' % (studentnr, timestamp)
+                out_f.writestr('%s_submission.%s' % (name, format_), nested_archive(format_, files))
+                out_f.writestr('%s.txt' % name, 'Name: Student %s\nDate Submitted: %s\n' % (studentnr, timestamp))
+    with open(gradecolumn, 'w', encoding='utf-8-sig', newline='') as out_f:
+        writer = csv.writer(out_f)
+        writer.writerow(['Last Name', 'First Name', 'Username', 'Student ID', 'Task [Total Pts: 10 Score] |1',
+                         'Feedback to Learner'])
+        for studentnr in studentnrs:
+            writer.writerow(['Student', studentnr, 's%s' % studentnr, studentnr, '', ''])
+    return (gradebook, gradecolumn, studentnrs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Blackboard gradebook')
+    parser.add_argument('--output', default='benchmark-gradebook')
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--formats', default='zip', help='Comma-separated list of %s' % ', '.join(FORMATS))
+    parser.add_argument('--members', type=int, default=6)
+    parser.add_argument('--member-size', type=int, default=4096)
+    parser.add_argument('--attempts', type=int, default=1)
+    parser.add_argument('--nested-fraction', type=float, default=0.3)
+    parser.add_argument('--compress', action='store_true', help='Compress the gradebook itself')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    gradebook, gradecolumn, _ = generate(args.output, args.students, args.formats.split(','), args.members,
+                                         args.member_size, args.attempts, args.nested_fraction,
+                                         compression=ZIP_DEFLATED if args.compress else ZIP_STORED, seed=args.seed)
+    print('Created %s and %s' % (gradebook, gradecolumn))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for loading, matching and writing back gradebooks.
+
+Each benchmark runs in a fresh Python process on a synthetic gradebook created by
+:mod:`gradebook`, so that the peak memory and the disk I/O (from ``/proc/self/io``)
+are those of the benchmark alone. The peak memory of the benchmark's own child processes is
+recorded separately, as that of the largest child. The results are stored as JSON in
+``benchmarks/results/<version>.json``, where the version is taken from
+``git describe``, and two result files can be compared::
+
+    python benchmarks/run.py --students 600 --formats zip,tar.gz,tar.bz2
+    python benchmarks/run.py --students 200 --formats rar --benchmarks ingest
+    python benchmarks/run.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, HERE)
+
+import gradebook as generator  # noqa: E402
+
+BENCHMARKS = {}
+SPEC_PATTERNS = [('html', r'\.html$'), ('css', r'\.css$'), ('js', r'\.js$'), ('php', r'\.php$')]
+
+
+def benchmark(name):
+    """Register a benchmark. It is called with the benchmark directory and returns the number of
+    ``items`` (students or rows) it processed."""
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _specs():
+    from automarking.core import SubmissionSpec
+    return [SubmissionSpec(identifier, identifier.upper(), pattern) for identifier, pattern in SPEC_PATTERNS]
+
+
+def _ingest(directory, options):
+    from automarking import mark
+    from automarking.core import BlackboardDataSource
+    source = BlackboardDataSource(os.path.join(directory, 'gradebook.zip'),
+                                  os.path.join(directory, 'gradecolumn.csv'), _specs(), options)
+    for part, data in mark(source):
+        if data is not None:
+            for _, member in (data if isinstance(data, list) else [data]):
+                member.read()
+    return len(_students(directory))
+
+
+@benchmark('ingest')
+def ingest(directory):
+    """Load every submission part with the default (eager) options."""
+    return _ingest(directory, {})
+
+
+@benchmark('ingest_streaming')
+def ingest_streaming(directory):
+    """Load every submission part with the ``streaming`` option."""
+    return _ingest(directory, {'streaming': True})
+
+
+@benchmark('match')
+def match(directory):
+    """Match the names of all files in the nested archives against the specs, ten times over."""
+    import tarfile
+    from zipfile import ZipFile
+    from automarking.core import SpecMatcher, submission_type
+    names = []
+    with ZipFile(os.path.join(directory, 'gradebook.zip')) as gradebook:
+        for info in gradebook.infolist():
+            type_ = submission_type(info.filename)
+            with gradebook.open(info) as nested:
+                if type_ == 'zip':
+                    with ZipFile(nested) as archive:
+                        names.extend(archive.namelist())
+                elif type_ == 'tar':
+                    with tarfile.open(fileobj=nested) as archive:
+                        names.extend(archive.getnames())
+    matcher = SpecMatcher(_specs())
+    start = time.perf_counter()
+    for _ in range(10):
+        for name in names:
+            matcher.match(name)
+    # Only the matching itself is of interest, not reading the names
+    return {'items': len(names) * 10, 'time': time.perf_counter() - start}
+
+
+@benchmark('fix_zips')
+def fix_zips(directory):
+    """Run ``GradeBookFix.fix_zips`` on the gradebook."""
+    from automarking.utils import GradeBookFix
+    fix = GradeBookFix('task_01', 'BENCH', ['.html', '.css', '.js', '.php'],
+                       os.path.join(directory, 'gradebook.zip'), directory + os.sep)
+    fix.fix_zips()
+    return len(_students(directory))
+
+
+@benchmark('fix_zips_streaming')
+def fix_zips_streaming(directory):
+    """Run ``GradeBookFix.fix_zips`` on the gradebook in the ``streaming`` mode."""
+    from automarking.utils import GradeBookFix
+    fix = GradeBookFix('task_01', 'BENCH', ['.html', '.css', '.js', '.php'],
+                       os.path.join(directory, 'gradebook.zip'), directory + os.sep)
+    fix.fix_zips(streaming=True)
+    return len(_students(directory))
+
+
+@benchmark('ultra_fix')
+def ultra_fix(directory):
+    """Run ``GradeBookFix.ultra_gradebook_submission_download_fix`` on the gradebook."""
+    from automarking.utils import GradeBookFix
+    fix = GradeBookFix('task_01', 'BENCH', ['.html', '.css', '.js', '.php'],
+                       os.path.join(directory, 'gradebook.zip'), directory + os.sep)
+    fix.ultra_gradebook_submission_download_fix()
+    return len(_students(directory))
+
+
+@benchmark('write_back')
+def write_back(directory):
+    """Write a score and feedback for every student to the grade column, ten times over."""
+    from automarking.core import GradeColumn
+    gradecolumn = os.path.join(directory, 'gradecolumn-write.csv')
+    shutil.copy(os.path.join(directory, 'gradecolumn.csv'), gradecolumn)
+    results = dict((studentnr, (8, ['<h4>Task</h4>', '\t<li>Well done %s</li>' % studentnr] * 5))
+                   for studentnr in _students(directory))
+    for _ in range(10):
+        GradeColumn(gradecolumn).write(results, reset_missing=True)
+    return len(results) * 10
+
+
+def _students(directory):
+    import csv
+    with open(os.path.join(directory, 'gradecolumn.csv'), encoding='utf-8-sig') as in_f:
+        return [row['Student ID'] for row in csv.DictReader(in_f)]
+
+
+def _proc_io():
+    """Return the I/O counters of this process, or an empty ``dict`` if they are not available."""
+    try:
+        with open('/proc/self/io') as in_f:
+            return dict((key, int(value)) for key, value in (line.split(': ') for line in in_f))
+    except OSError:
+        return {}
+
+
+def _peak_rss(children=False):
+    """Return the peak RSS of this process in bytes, or with ``children`` that of the largest child
+    process that has finished (such as ``ProcessPoolExecutor`` workers or the RAR tool), as the
+    peak of this process alone does not include them."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_child(name, directory):
+    """Run the benchmark ``name`` in this process and print its measurements as JSON."""
+    os.chdir(directory)
+    baseline_rss = _peak_rss()
+    io_before = _proc_io()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        result = BENCHMARKS[name](directory)
+    elapsed = time.perf_counter() - start
+    io_after = _proc_io()
+    if not isinstance(result, dict):
+        result = {'items': result, 'time': elapsed}
+    measurement = {'items': result['items'],
+                   'time': result['time'],
+                   'throughput': result['items'] / result['time'] if result['time'] > 0 else None,
+                   'baseline_rss': baseline_rss,
+                   'peak_rss': _peak_rss(),
+                   'children_peak_rss': _peak_rss(children=True)}
+    for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+        if key in io_before and key in io_after:
+            measurement[key] = io_after[key] - io_before[key]
+    print(json.dumps(measurement))
+
+
+def _version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(args):
+    """Generate the gradebook and run the selected benchmarks, each in a fresh process and on a
+    fresh copy of the gradebook directory."""
+    names = args.benchmarks.split(',') if args.benchmarks else sorted(BENCHMARKS)
+    config = {'students': args.students, 'formats': args.formats.split(','), 'members': args.members,
+              'member_size': args.member_size, 'attempts': args.attempts}
+    results = {'version': _version(), 'python': sys.version.split()[0], 'config': config, 'benchmarks': {}}
+    with tempfile.TemporaryDirectory(prefix='automarking-benchmark-') as scratch:
+        source = os.path.join(scratch, 'source')
+        generator.generate(source, args.students, config['formats'], args.members, args.member_size, args.attempts)
+        results['gradebook_size'] = os.path.getsize(os.path.join(source, 'gradebook.zip'))
+        for name in names:
+            runs = []
+            for repeat in range(args.repeat):
+                directory = os.path.join(scratch, '%s-%i' % (name, repeat))
+                shutil.copytree(source, directory)
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                                  '--child', name, '--directory', directory],
+                                                 stderr=None if args.verbose else subprocess.DEVNULL)
+                runs.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+                shutil.rmtree(directory)
+            # Report the fastest run, which is the least affected by other activity on the machine
+            best = min(runs, key=lambda measurement: measurement['time'])
+            best['runs'] = [measurement['time'] for measurement in runs]
+            results['benchmarks'][name] = best
+            print('%-18s %9.3fs %12.1f items/s %8.1f MB peak %8.1f MB peak of children'
+                  % (name, best['time'], best['throughput'] or 0, (best['peak_rss'] or 0) / 1024 / 1024,
+                     (best.get('children_peak_rss') or 0) / 1024 / 1024))
+    output_dir = os.path.join(HERE, 'results')
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    output = args.output or os.path.join(output_dir, '%s.json' % results['version'])
+    with open(output, 'w', encoding='utf-8') as out_f:
+        json.dump(results, out_f, indent=2)
+    print('Results written to %s' % output)
+
+
+def compare(old_filename, new_filename):
+    """Print the change of each benchmark between two result files."""
+    with open(old_filename, encoding='utf-8') as in_f:
+        old = json.load(in_f)
+    with open(new_filename, encoding='utf-8') as in_f:
+        new = json.load(in_f)
+    print('%-18s %10s %10s %8s %10s %10s' % ('Benchmark', old['version'][:10], new['version'][:10], 'Change',
+                                             'Old peak', 'New peak'))
+    for name in sorted(set(old['benchmarks']) & set(new['benchmarks'])):
+        before = old['benchmarks'][name]
+        after = new['benchmarks'][name]
+        print('%-18s %9.3fs %9.3fs %+7.1f%% %8.1fMB %8.1fMB' % (name, before['time'], after['time'],
+                                                               (after['time'] / before['time'] - 1) * 100,
+                                                               (before['peak_rss'] or 0) / 1024 / 1024,
+                                                               (after['peak_rss'] or 0) / 1024 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the automarking benchmarks')
+    parser.add_argument('--benchmarks', help='Comma-separated list of %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--formats', default='zip,tar.gz,tar.bz2')
+    parser.add_argument('--members', type=int, default=6)
+    parser.add_argument('--member-size', type=int, default=4096)
+    parser.add_argument('--attempts', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='The file to write the results to')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the benchmarked code')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child, args.directory)
+    elif args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,7 @@ setup(name='Automarking',
       packages=find_packages('src'),
       package_dir = {'': 'src'},
       include_package_data=True,
+      package_data={'automarking': ['harness/*.js', 'harness/*.php']},
       zip_safe=False,
       install_requires=requires,
 )
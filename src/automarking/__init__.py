@@ -6,10 +6,22 @@
 Provides the :func:`~automarking.mark` function that takes a :class:`~automarking.core.BlackboardDataSource`
 and returns all the :class:`~automarking.core.SubmissionPart`\ s that have been identified from the
 :class:`~automarking.core.SubmissionSpec`\ s passed to the :class:`~automarking.core.BlackboardDataSource`.
+The :func:`~automarking.mark_parallel` function marks the same
+:class:`~automarking.core.SubmissionPart`\ s across a pool of processes and :func:`~automarking.mark_async`
+marks them concurrently using :mod:`asyncio`.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-from .core import BlackboardDataSource, SubmissionSpec
+import asyncio
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from .core import BlackboardDataSource, SubmissionSpec, SubmissionPart
+from .instrument import instrumentation
 
 
 def mark(source):
@@ -21,16 +33,206 @@ def mark(source):
 
     The function acts as a generator and can thus be used in ``for`` loops.
 
+    If the :class:`~automarking.core.BlackboardDataSource` has the ``deduplicate`` option set, then
+    only the first of a group of identical :class:`~automarking.core.SubmissionPart`\ s is yielded and
+    its score and feedback are copied to the others.
+
     :param source: The data source to load :class:`~automarking.core.SubmissionPart`\ s from.
     :type source: :class:`~automarking.core.BlackboardDataSource`
     """ 
     with source as submissions:
+        deduplicator = source.deduplicator
         for submission in submissions:
             with submission as parts:
                 for part in parts:
                     with part as data:
-                        if isinstance(data, list):
-                            for sub_data in data:
-                                yield (part, sub_data)
-                        else:
-                            yield (part, data)
+                        if deduplicator is not None:
+                            key = deduplicator.key(part)
+                            deduplicator.register(key, submission.studentnr)
+                            if deduplicator.apply(key, part):
+                                continue
+                            feedback_length = len(part.feedback)
+                        with instrumentation.phase('mark', studentnr=submission.studentnr, spec=part.spec.identifier):
+                            if isinstance(data, list):
+                                for sub_data in data:
+                                    yield (part, sub_data)
+                            else:
+                                yield (part, data)
+                        if deduplicator is not None:
+                            deduplicator.record(key, part, feedback_length)
+
+
+def mark_parallel(source, marker, processes=None):
+    """Takes a :class:`~automarking.core.BlackboardDataSource` and marks each of its
+    :class:`~automarking.core.SubmissionPart`\ s in a pool of processes. For each part the ``marker``
+    is called in the same way that :func:`~automarking.mark` yields them, with the
+    :class:`~automarking.core.SubmissionPart` and the (filename, filedata) tuple (or ``None``), and
+    must set the part's ``score`` and ``feedback``. Only the ``score``, ``feedback`` and ``resources``
+    are copied back from the worker processes.
+
+    The scores and feedback are collected back into the :class:`~automarking.core.Submission`\ s in the
+    order in which the :class:`~automarking.core.BlackboardDataSource` provides them, so the grade column
+    is written exactly as with :func:`~automarking.mark`. Only a limited number of submissions are
+    sent to the pool ahead of the one being collected, so this also works with the ``streaming``
+    option. With the ``deduplicate`` option, identical parts are only sent to the pool once.
+
+    :param source: The data source to load :class:`~automarking.core.SubmissionPart`\ s from.
+    :type source: :class:`~automarking.core.BlackboardDataSource`
+    :param marker: The function that marks a single :class:`~automarking.core.SubmissionPart`. Must be
+                   picklable, i.e. defined at the top level of a module.
+    :type marker: ``callable``
+    :param processes: The number of processes to use. Defaults to the number of CPUs.
+    :type processes: ``int``
+    """
+    processes = processes if processes is not None else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        with source as submissions:
+            deduplicator = source.deduplicator
+            shared = {}
+            pending = deque()
+            for submission in submissions:
+                futures = []
+                for part in submission.parts:
+                    if deduplicator is not None:
+                        key = deduplicator.key(part)
+                        if deduplicator.register(key, submission.studentnr):
+                            futures.append((shared[key], False))
+                            continue
+                    future = executor.submit(_mark_part, marker, part.spec, _part_data(part), part.feedback)
+                    if deduplicator is not None:
+                        shared[key] = future
+                    futures.append((future, True))
+                pending.append((submission, futures))
+                while len(pending) > processes * 2:
+                    _collect_submission(*pending.popleft())
+            while pending:
+                _collect_submission(*pending.popleft())
+
+
+def _part_data(part):
+    """Convert the data of the ``part`` into (filename, ``bytes``) tuples that can be sent to a worker."""
+    if part.data is None:
+        return None
+    elif isinstance(part.data, list):
+        return [(filename, data.getvalue()) for filename, data in part.data]
+    else:
+        return (part.data[0], part.data[1].getvalue())
+
+
+def _mark_part(marker, spec, data, feedback):
+    """Run the ``marker`` on a :class:`~automarking.core.SubmissionPart` rebuilt from the ``spec``,
+    ``data`` and existing ``feedback`` in a worker process and return the resulting (score, feedback
+    added while marking, resources, duration)."""
+    start = time.perf_counter()
+    part = SubmissionPart(spec)
+    part.feedback = list(feedback)
+    if isinstance(data, list):
+        part.data = [(filename, BytesIO(filedata)) for filename, filedata in data]
+    elif data is not None:
+        part.data = (data[0], BytesIO(data[1]))
+    with part as part_data:
+        if isinstance(part_data, list):
+            for sub_data in part_data:
+                marker(part, sub_data)
+        else:
+            marker(part, part_data)
+        added = part.feedback[len(feedback):]
+    return (part.score, added, part.resources, time.perf_counter() - start)
+
+
+def _collect_submission(submission, futures):
+    with submission as parts:
+        for part, (future, marked) in zip(parts, futures):
+            score, feedback, resources, duration = future.result()
+            # As with mark(), identical parts only get the feedback added while marking
+            with part:
+                part.score = score
+                part.feedback.extend(feedback)
+                part.resources = list(resources)
+            if marked:
+                instrumentation.event('mark', duration, studentnr=submission.studentnr, spec=part.spec.identifier)
+
+
+def mark_async(source, marker, concurrency=16):
+    """Takes a :class:`~automarking.core.BlackboardDataSource` and marks its
+    :class:`~automarking.core.SubmissionPart`\ s concurrently. The ``marker`` is a coroutine function
+    that is called in the same way that :func:`~automarking.mark` yields the parts, with the
+    :class:`~automarking.core.SubmissionPart` and the (filename, filedata) tuple (or ``None``). It
+    would normally await :func:`~automarking.tests.run_test_async`, sharing a
+    :class:`~automarking.tests.TestLimiter` to limit the number of concurrent test processes.
+
+    As with :func:`~automarking.mark_parallel` the results are collected into the
+    :class:`~automarking.core.Submission`\ s in the order in which the
+    :class:`~automarking.core.BlackboardDataSource` provides them, and identical parts are only
+    marked once if the ``deduplicate`` option is set.
+
+    :param source: The data source to load :class:`~automarking.core.SubmissionPart`\ s from.
+    :type source: :class:`~automarking.core.BlackboardDataSource`
+    :param marker: The coroutine function that marks a single :class:`~automarking.core.SubmissionPart`
+    :type marker: ``callable``
+    :param concurrency: The maximum number of submissions that are marked at the same time
+    :type concurrency: ``int``
+    """
+    asyncio.run(_mark_async(source, marker, concurrency))
+
+
+async def _mark_async(source, marker, concurrency):
+    with source as submissions:
+        deduplicator = source.deduplicator
+        shared = {}
+        pending = deque()
+        try:
+            for submission in submissions:
+                tasks = []
+                for part in submission.parts:
+                    # The data is taken now, as a streaming source releases it when the next
+                    # submission is requested
+                    part.load()
+                    key = None
+                    if deduplicator is not None:
+                        key = deduplicator.key(part)
+                        if deduplicator.register(key, submission.studentnr):
+                            tasks.append(asyncio.ensure_future(_copy_part_async(shared[key], deduplicator, key, part, part.__enter__())))
+                            continue
+                    task = asyncio.ensure_future(_mark_part_async(marker, part, part.__enter__(), deduplicator, key,
+                                                                  submission.studentnr))
+                    shared[key] = task
+                    tasks.append(task)
+                pending.append((submission, tasks))
+                while len(pending) >= concurrency:
+                    await _collect_submission_async(*pending.popleft())
+            while pending:
+                await _collect_submission_async(*pending.popleft())
+        finally:
+            for _, tasks in pending:
+                for task in tasks:
+                    task.cancel()
+
+
+async def _mark_part_async(marker, part, part_data, deduplicator=None, key=None, studentnr=None):
+    try:
+        feedback_length = len(part.feedback)
+        with instrumentation.phase('mark', studentnr=studentnr, spec=part.spec.identifier):
+            if isinstance(part_data, list):
+                for sub_data in part_data:
+                    await marker(part, sub_data)
+            else:
+                await marker(part, part_data)
+        if deduplicator is not None:
+            deduplicator.record(key, part, feedback_length)
+    finally:
+        part.__exit__(None, None, None)
+
+
+async def _copy_part_async(task, deduplicator, key, part, part_data):
+    """Wait for the ``task`` marking an identical part and copy its results to the ``part``."""
+    try:
+        await asyncio.shield(task)
+        deduplicator.apply(key, part)
+    finally:
+        part.__exit__(None, None, None)
+
+
+async def _collect_submission_async(submission, tasks):
+    with submission as parts:
+        await asyncio.gather(*tasks)
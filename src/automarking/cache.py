@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+###############################################
+:mod:`automarking.cache` -- Persistent Caches
+###############################################
+
+Caches that keep the results of expensive marking steps between runs, so that
+re-marking a gradebook only repeats the work for submissions that have changed.
+The caches are stored in SQLite databases and can be shared between the
+processes used by :func:`~automarking.mark_parallel`.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from .instrument import instrumentation
+
+
+class _SQLiteCache(object):
+    """Base class for the caches, storing JSON values in a single SQLite table, with
+    least-recently-used eviction once the stored values exceed ``max_size`` bytes. The total size
+    of the values is kept in the one-row ``meta`` table, updated in the same transaction as the
+    entries, so that it never has to be summed over the whole table. Eviction removes entries
+    until the cache is at :attr:`EVICT_TO` of its ``max_size``, so that it is not needed again
+    for the next few entries."""
+
+    EVICT_TO = 0.9
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,
+                                                   tag TEXT,
+                                                   value TEXT,
+                                                   size INTEGER,
+                                                   created REAL,
+                                                   last_used REAL)'''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # Connections cannot be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute(self.SCHEMA)
+            self._connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS entries_tag ON entries (tag)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS entries_created ON entries (created)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS meta (total_size INTEGER)')
+            # Caches created before the meta table are summed once
+            self._connection.execute('INSERT INTO meta SELECT COALESCE(SUM(size), 0) FROM entries '
+                                     'WHERE NOT EXISTS (SELECT 1 FROM meta)')
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def _get(self, key, max_age=None):
+        row = self.connection.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or (max_age is not None and row[1] < time.time() - max_age):
+            self.misses = self.misses + 1
+            instrumentation.count('%s.misses' % type(self).__name__)
+            return None
+        self.hits = self.hits + 1
+        instrumentation.count('%s.hits' % type(self).__name__)
+        with self.connection:
+            self.connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def _put(self, key, tag, value, max_age=None):
+        value = json.dumps(value)
+        now = time.time()
+        size = len(key) + len(value)
+        with self.connection:
+            # The first statement takes the write lock, so that no other process changes the entry in between
+            self.connection.execute('UPDATE meta SET total_size = total_size + ? - '
+                                    'COALESCE((SELECT size FROM entries WHERE key = ?), 0)', (size, key))
+            self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                                    (key, tag, value, size, now, now))
+            self._evict(max_age)
+
+    def _delete(self, where, parameters):
+        """Delete the entries matching the ``where`` clause and subtract their size from the total."""
+        self.connection.execute('UPDATE meta SET total_size = total_size - '
+                                '(SELECT COALESCE(SUM(size), 0) FROM entries WHERE %s)' % where, parameters)
+        self.connection.execute('DELETE FROM entries WHERE %s' % where, parameters)
+
+    def _evict(self, max_age):
+        if max_age is not None:
+            self._delete('created < ?', (time.time() - max_age,))
+        if self.max_size is not None:
+            total = self.connection.execute('SELECT total_size FROM meta').fetchone()[0]
+            if total > self.max_size:
+                rows = self.connection.execute('SELECT key, size FROM entries ORDER BY last_used')
+                evicted = []
+                evicted_size = 0
+                for key, size in rows:
+                    if total - evicted_size <= self.max_size * self.EVICT_TO:
+                        break
+                    evicted.append((key,))
+                    evicted_size = evicted_size + size
+                rows.close()
+                self.connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+                self.connection.execute('UPDATE meta SET total_size = total_size - ?', (evicted_size,))
+
+    def evict(self, max_age=None):
+        """Remove the least recently used entries if the cache is larger than its ``max_size`` and,
+        if ``max_age`` is given, all entries older than ``max_age`` seconds."""
+        with self.connection:
+            self._evict(max_age)
+
+    def invalidate(self, tag=None):
+        """Remove all entries with the given ``tag`` or, if no ``tag`` is given, all entries."""
+        with self.connection:
+            if tag is None:
+                self.connection.execute('DELETE FROM entries')
+                self.connection.execute('UPDATE meta SET total_size = 0')
+            else:
+                self._delete('tag = ?', (tag,))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class TestResultCache(_SQLiteCache):
+    """The :class:`~automarking.cache.TestResultCache` stores the score and feedback that a test
+    produced for a :class:`~automarking.core.SubmissionPart`. The key is a hash of the part's
+    content, the test command and its parameters, and the content of every parameter that is a
+    file (the test files), so that changing either the submission or the test re-runs the test.
+
+    Pass it to :func:`~automarking.tests.run_test` using the ``cache`` parameter. Entries are
+    tagged with the :class:`~automarking.core.SubmissionSpec` identifier, so that the results for
+    a single spec can be invalidated after its test has been fixed::
+
+        cache = TestResultCache('results.sqlite')
+        cache.invalidate('task1.js')
+    """
+
+    def __init__(self, path='automarking-results.sqlite', max_size=256 * 1024 * 1024):
+        """:param path: The filename of the cache database
+        :type path: ``unicode``
+        :param max_size: The maximum size in bytes of the cached results
+        :type max_size: ``int``
+        """
+        _SQLiteCache.__init__(self, path, max_size)
+
+    def key(self, submission_file, command, parameters, *extra):
+        """Calculate the cache key for running the test ``command`` with ``parameters`` on the
+        ``submission_file``. Any ``extra`` values that influence the result are included in the key.
+
+        :rtype: ``unicode``
+        """
+        digest = hashlib.sha256()
+        digest.update(submission_file.fingerprint().encode('utf-8'))
+        for value in [command] + list(parameters) + [repr(value) for value in extra]:
+            digest.update(b'\0')
+            digest.update(str(value).encode('utf-8'))
+            if isinstance(value, str) and os.path.isfile(value):
+                with open(value, 'rb') as in_f:
+                    for chunk in iter(lambda: in_f.read(65536), b''):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached (score, feedback) for the ``key`` or ``None``. The score is ``None`` if
+        the test did not change it."""
+        value = self._get(key)
+        return tuple(value) if value is not None else None
+
+    def put(self, key, spec_identifier, score, feedback):
+        """Store the ``score`` and ``feedback`` that a test added for the ``key``."""
+        self._put(key, spec_identifier, [score, feedback])
+
+    def apply(self, key, submission_file):
+        """Apply the cached result for the ``key`` to the ``submission_file``.
+
+        :return: ``True`` if there was a cached result, ``False`` otherwise
+        :rtype: ``boolean``
+        """
+        value = self.get(key)
+        if value is None:
+            return False
+        if value[0] is not None:
+            submission_file.score = value[0]
+        submission_file.feedback.extend(value[1])
+        return True
+
+    def record(self, key, submission_file, score, feedback_length):
+        """Store the result of a test that has just run on the ``submission_file``. ``score`` and
+        ``feedback_length`` are the part's score and number of feedback items before the test ran."""
+        self.put(key, submission_file.spec.identifier,
+                 submission_file.score if submission_file.score != score else None,
+                 submission_file.feedback[feedback_length:])
+
+
+class ValidatorCache(_SQLiteCache):
+    """The :class:`~automarking.cache.ValidatorCache` stores the results of the HTML and CSS
+    validators, keyed by a hash of the validated file's content, the output format and the
+    validator URL. Many students submit identical starter files, so repeated validations then only
+    cost a lookup instead of a request to the validator.
+
+    Pass it to :func:`~automarking.tests.run_html_validator` or
+    :func:`~automarking.tests.run_css_validator` using the ``cache`` parameter. The ``hits`` and
+    ``misses`` attributes count how often the cache could be used.
+    """
+
+    def __init__(self, path='automarking-validator.sqlite', max_size=64 * 1024 * 1024, ttl=7 * 24 * 60 * 60):
+        """:param path: The filename of the cache database
+        :type path: ``unicode``
+        :param max_size: The maximum size in bytes of the cached results
+        :type max_size: ``int``
+        :param ttl: The number of seconds after which a cached result expires
+        :type ttl: ``int``
+        """
+        _SQLiteCache.__init__(self, path, max_size)
+        self.ttl = ttl
+
+    def key(self, content, output_format, url):
+        """Calculate the cache key for validating the ``content`` (``bytes``) with the validator
+        at ``url``, using the ``output_format``.
+
+        :rtype: ``unicode``
+        """
+        digest = hashlib.sha256(content)
+        digest.update(b'\0')
+        digest.update(output_format.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(url.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached validation result for the ``key`` or ``None`` if there is none or it has expired."""
+        return self._get(key, max_age=self.ttl)
+
+    def put(self, key, url, result):
+        """Store the validation ``result`` for the ``key``. Expired entries are removed at the same time."""
+        self._put(key, url, result, max_age=self.ttl)
+
+    def stats(self):
+        """Return the number of cache hits and misses as a ``dict``."""
+        return {'hits': self.hits, 'misses': self.misses}
@@ -11,23 +11,225 @@ that loads data from the files downloaded from by Blackboard.
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 .. moduleauthor:: Dan Campbell <campbeld@edgehill.ac.uk>
 """
+import hashlib
+import json
 import os
 import re
+import shutil
+import signal
+import subprocess
 import tarfile
+import zlib
 
 from csv import DictReader, DictWriter
+from functools import partial
 from io import BytesIO
-from rarfile import RarFile, BadRarFile, NotRarFile
-from zipfile import ZipFile, BadZipFile
+from rarfile import RarFile, BadRarFile, NotRarFile, RAR_M0, Blake2SP, tool_setup, Error as RarError
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from zipfile import ZipFile, BadZipFile, ZIP_STORED
+
+from .instrument import instrumentation
+from .journal import MarkingJournal
 
 STUDENTNR = re.compile(r'[0-9]{8,9}')
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+BACKREFERENCE = re.compile(r'\\[0-9]|\(\?P=|\(\?\(')
+ATTEMPT = re.compile(r'([^_/]+)_attempt_([0-9]{4}(?:-[0-9]{2}){5})')
+RAR_MAX_ARGS = 32 * 1024
+RAR_TOOL_TIMEOUT = 120
+MEMBER_READ_ERRORS = (BadZipFile, zlib.error, EOFError, OSError, tarfile.TarError, RarError)
+
+
+def submission_type(filename):
+    """Determine the type of a submission from its ``filename``.
+
+    :param filename: The filename to check
+    :type filename: ``unicode``
+    :return: One of ``'tar'``, ``'zip'``, ``'rar'``, ``'txt'``, or ``'other'``
+    :rtype: ``unicode``
+    """
+    if filename.lower().endswith('.tar.bz2') or filename.endswith('.tar.gz'):
+        return 'tar'
+    elif filename.lower().endswith('.zip'):
+        return 'zip'
+    elif filename.lower().endswith('.rar'):
+        return 'rar'
+    elif filename.endswith('.txt'):
+        return 'txt'
+    else:
+        return 'other'
+
+
+def format_size(size):
+    """Format the ``size`` in bytes for use in feedback."""
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            return '%i %s' % (size, unit) if unit == 'bytes' else '%.1f %s' % (size, unit)
+        size = size / 1024
+    return '%.1f GB' % size
+
+
+class GradebookMember(object):
+    """Information about a single file in the gradebook, taken from the zip central directory."""
+
+    def __init__(self, filename, type_, size, compressed_size, timestamp, position):
+        self.filename = filename
+        self.type = type_
+        self.size = size
+        self.compressed_size = compressed_size
+        self.timestamp = timestamp
+        self.position = position
+
+    def to_json(self):
+        return [self.filename, self.type, self.size, self.compressed_size, self.timestamp, self.position]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data)
+
+
+class GradebookIndex(object):
+    """The :class:`~automarking.core.GradebookIndex` maps each student to their attempts and each
+    attempt to the :class:`~automarking.core.GradebookMember`\ s that belong to it. It is built
+    in a single pass over the gradebook's central directory. The student and the attempt are
+    taken from the ``<user>_attempt_<timestamp>`` part of the filename, with the student number in
+    ``<user>`` as the key, or ``<user>`` itself if it contains none. Files without an attempt
+    timestamp are stored under the attempt ``''``, for the first student number in their
+    filename."""
+
+    VERSION = 2
+
+    def __init__(self, students=None):
+        self.students = students if students is not None else {}
+
+    @classmethod
+    def build(cls, gradebook):
+        """Build the index from an open gradebook.
+
+        :param gradebook: The gradebook to index
+        :type gradebook: :class:`~zipfile.ZipFile`
+        :rtype: :class:`~automarking.core.GradebookIndex`
+        """
+        index = cls()
+        for position, info in enumerate(gradebook.infolist()):
+            if info.is_dir():
+                continue
+            student, attempt = cls.student(info.filename)
+            if student is None:
+                continue
+            member = GradebookMember(info.filename,
+                                     submission_type(info.filename),
+                                     info.file_size,
+                                     info.compress_size,
+                                     '%04i-%02i-%02i-%02i-%02i-%02i' % info.date_time,
+                                     position)
+            index.students.setdefault(student, {}).setdefault(attempt, []).append(member)
+        return index
+
+    @staticmethod
+    def student(filename):
+        """Identify the student and the attempt that the gradebook file ``filename`` belongs to.
+
+        :return: (student, attempt), with the student ``None`` if the filename identifies no
+                 student and the attempt ``''`` if it has no timestamp
+        :rtype: ``tuple``
+        """
+        match = ATTEMPT.search(filename)
+        if match:
+            studentnr = STUDENTNR.search(match.group(1))
+            return (studentnr.group() if studentnr else match.group(1), match.group(2))
+        studentnr = STUDENTNR.search(filename)
+        return (studentnr.group() if studentnr else None, '')
+
+    @classmethod
+    def load(cls, gradebook_filename, gradebook=None, persist=False):
+        """Load the index for the gradebook at ``gradebook_filename``. If ``persist`` is ``True``,
+        then the index is cached in a file next to the gradebook and only rebuilt if the gradebook
+        has changed.
+
+        :param gradebook_filename: The filename of the gradebook
+        :type gradebook_filename: ``unicode``
+        :param gradebook: An already opened gradebook to index. If not given, it is opened from
+                          ``gradebook_filename``.
+        :type gradebook: :class:`~zipfile.ZipFile`
+        :param persist: Whether to cache the index next to the gradebook
+        :type persist: ``boolean``
+        :rtype: :class:`~automarking.core.GradebookIndex`
+        """
+        index_filename = '%s.index.json' % gradebook_filename
+        stat = os.stat(gradebook_filename)
+        signature = [cls.VERSION, stat.st_size, stat.st_mtime_ns]
+        if persist and os.path.exists(index_filename):
+            try:
+                with open(index_filename, encoding='utf-8') as in_f:
+                    data = json.load(in_f)
+                if data['signature'] == signature:
+                    return cls(dict((studentnr, dict((attempt, [GradebookMember.from_json(member)
+                                                                for member in members])
+                                                     for attempt, members in attempts.items()))
+                                    for studentnr, attempts in data['students'].items()))
+            except (ValueError, KeyError, TypeError):
+                pass
+        if gradebook is None:
+            with ZipFile(gradebook_filename) as gradebook:
+                index = cls.build(gradebook)
+        else:
+            index = cls.build(gradebook)
+        if persist:
+            with open(index_filename, 'w', encoding='utf-8') as out_f:
+                json.dump({'signature': signature,
+                           'students': dict((studentnr, dict((attempt, [member.to_json() for member in members])
+                                                             for attempt, members in attempts.items()))
+                                            for studentnr, attempts in index.students.items())},
+                          out_f)
+        return index
+
+    def __contains__(self, studentnr):
+        return studentnr in self.students
+
+    def attempts(self, studentnr):
+        """Return the attempts for ``studentnr`` as a list of (timestamp, ``list`` of
+        :class:`~automarking.core.GradebookMember`) tuples, oldest first."""
+        return sorted(self.students.get(studentnr, {}).items())
+
+    def select_attempt(self, studentnr, policy='last'):
+        """Select one of the attempts of ``studentnr``. Files without an attempt timestamp are only
+        selected if the student has no timestamped attempt.
+
+        :param policy: ``last`` selects the newest attempt, ``first`` the oldest and ``largest`` the
+                       one with the largest total size of its files
+        :type policy: ``unicode``
+        :return: The selected (timestamp, ``list`` of :class:`~automarking.core.GradebookMember`)
+                 tuple, or ``None`` if the student has no files
+        :rtype: ``tuple``
+        """
+        attempts = [attempt for attempt in self.attempts(studentnr) if attempt[0]] or self.attempts(studentnr)
+        if not attempts:
+            return None
+        if policy == 'last':
+            return attempts[-1]
+        elif policy == 'first':
+            return attempts[0]
+        elif policy == 'largest':
+            # The newest wins if several attempts have the same size
+            return max(reversed(attempts), key=lambda attempt: sum(member.size for member in attempt[1]))
+        raise ValueError('Unknown attempt policy %r' % policy)
+
+    def members(self, studentnr):
+        """Return all :class:`~automarking.core.GradebookMember`\ s for ``studentnr`` in the order
+        in which they appear in the gradebook."""
+        members = []
+        for attempt in self.students.get(studentnr, {}).values():
+            members.extend(attempt)
+        members.sort(key=lambda member: member.position)
+        return members
 
 
 class SubmissionSpec(object):
     """The :class:`~core.automarking.SubmissionSpec` is used in the user scripts
     to specify which files to extract from each student's submission."""
 
-    def __init__(self, identifier, title, pattern):
+    def __init__(self, identifier, title, pattern, max_member_size=None, max_total_size=None, harness=None):
         """:param identifier: Identifier to use
         :param title: Title of the submission, which will be used to label feedback
                       in the mark / feedback output
@@ -37,10 +239,34 @@ class SubmissionSpec(object):
                         regular expressions, in which case at least one of those
                         must match.
         :type pattern: RegExp or ``list`` of RegExp
+        :param max_member_size: The maximum size in bytes of a single matching file. Larger files
+                                are not extracted.
+        :type max_member_size: ``int``
+        :param max_total_size: The maximum size in bytes of all matching files together. Files that
+                               would exceed this are not extracted.
+        :type max_total_size: ``int``
+        :param harness: Run the tests for this spec on a pool of warm test harness processes
+        :type harness: :class:`~automarking.tests.HarnessPool`
         """
         self.identifier = identifier
         self.title = title
         self.pattern = pattern
+        self.max_member_size = max_member_size
+        self.max_total_size = max_total_size
+        self.harness = harness
+        self._compiled = None
+
+    @property
+    def patterns(self):
+        """The pattern(s) of this :class:`~automarking.core.SubmissionSpec` as a ``list``."""
+        return self.pattern if isinstance(self.pattern, list) else [self.pattern]
+
+    def compiled(self):
+        """Return the compiled pattern(s) of this :class:`~automarking.core.SubmissionSpec` as a ``list``.
+        The patterns are only compiled once."""
+        if self._compiled is None or self._compiled[0] is not self.pattern:
+            self._compiled = (self.pattern, [re.compile(pattern) for pattern in self.patterns])
+        return self._compiled[1]
 
     def matches(self, filename):
         """Test whether the ``filename`` is matched by this
@@ -52,17 +278,103 @@ class SubmissionSpec(object):
         :rtype: ``boolean``
         """
         if isinstance(self.pattern, list):
-            for pattern in self.pattern:
-                if re.search(pattern, filename):
+            for pattern in self.compiled():
+                if pattern.search(filename):
                     return True
             return False
         else:
-            return re.search(self.pattern, filename)
+            return self.compiled()[0].search(filename)
+
+
+class SpecMatcher(object):
+    """The :class:`~automarking.core.SpecMatcher` classifies filenames against a list of
+    :class:`~automarking.core.SubmissionSpec`\ s in a single pass.
+
+    All patterns are combined into a single compiled expression, with one optional lookahead
+    (and named group) per pattern, so that one match determines every
+    :class:`~automarking.core.SubmissionSpec` that the filename satisfies. Filenames that no
+    pattern matches are rejected by a combined alternation first. Patterns that cannot be combined
+    (for example because they use back-references or inline flags) are matched individually."""
+
+    def __init__(self, specs):
+        """:param specs: The specs to match against
+        :type specs: :py:class:`list` of :class:`~automarking.core.SubmissionSpec`
+        """
+        self.specs = list(specs)
+        self._groups = []
+        alternatives = []
+        lookaheads = []
+        try:
+            for idx, spec in enumerate(self.specs):
+                names = []
+                for pattern_idx, pattern in enumerate(spec.patterns):
+                    if isinstance(pattern, re.Pattern):
+                        if pattern.flags & ~re.UNICODE:
+                            raise re.error('Pattern flags cannot be combined')
+                        pattern = pattern.pattern
+                    if BACKREFERENCE.search(pattern):
+                        raise re.error('Back-references cannot be combined')
+                    name = 's%i_%i' % (idx, pattern_idx)
+                    names.append(name)
+                    alternatives.append('(?:%s)' % pattern)
+                    lookaheads.append('(?:(?=(?s:.*?)(?P<%s>%s))|)' % (name, pattern))
+                self._groups.append(names)
+            self._any = re.compile('|'.join(alternatives)) if alternatives else None
+            self._combined = re.compile(''.join(lookaheads))
+        except re.error:
+            self._any = None
+            self._combined = None
+
+    @classmethod
+    def create(cls, specs):
+        """Return ``specs`` if they already are a :class:`~automarking.core.SpecMatcher`, otherwise
+        create a new :class:`~automarking.core.SpecMatcher` for them."""
+        return specs if isinstance(specs, cls) else cls(specs)
+
+    def match(self, filename):
+        """Determine which :class:`~automarking.core.SubmissionSpec`\ s match the ``filename``.
+
+        :param filename: The filename to check
+        :type filename: ``unicode``
+        :return: The indices of the matching :class:`~automarking.core.SubmissionSpec`\ s
+        :rtype: :py:class:`list` of ``int``
+        """
+        if self._combined is None:
+            return [idx for idx, spec in enumerate(self.specs) if spec.matches(filename)]
+        if self._any is None or not self._any.search(filename):
+            return []
+        match = self._combined.match(filename)
+        return [idx for idx, names in enumerate(self._groups)
+                if any(match.group(name) is not None for name in names)]
 
 
 class BlackboardDataSource(object):
     """The :class:`~automarking.core.BlackboardDataSource` handles loading the
-    student submissions from a Blackboard download for offline marking."""
+    student submissions from a Blackboard download for offline marking.
+
+    The following keys are supported in the ``options``:
+
+    * ``no_submission_message`` -- Feedback to use for students without a submission.
+    * ``streaming`` -- If ``True``, then each :class:`~automarking.core.Submission` is only
+      loaded when it is requested and its data is released once the next one is requested.
+      Marking then starts immediately and only one submission is held in memory at a time.
+    * ``persist_index`` -- If ``True``, then the :class:`~automarking.core.GradebookIndex` is
+      cached next to the gradebook, so that repeated runs do not need to rebuild it.
+    * ``spool_max_size`` -- Nested archives are read straight from the gradebook into memory.
+      Archives larger than this size in bytes (default 64MB) are spilled to disk in ``tmp/``.
+    * ``journal`` -- Filename of a :class:`~automarking.journal.MarkingJournal` that records each
+      :class:`~automarking.core.Submission` as soon as it has been marked.
+    * ``resume`` -- If ``True``, then submissions that the ``journal`` shows as already marked, with
+      unchanged files and specs, are not marked again and their recorded score and feedback are
+      written to the grade column on exit.
+    * ``deduplicate`` -- If ``True``, then :class:`~automarking.core.SubmissionPart`\ s with identical
+      content are only marked once and the score and feedback are copied to the others. The
+      groups of identical parts are available from the ``deduplicator``.
+    * ``write_back_every`` -- Write the results to the grade column every time this many
+      students have been marked, rather than only on exit.
+    * ``instrument`` -- Filename to write the timing events of the run to (see
+      :mod:`~automarking.instrument`). The summary is written to it on exit.
+    """
 
     def __init__(self, gradebook, gradecolumn, specs, options=None):
         """:param gradebook:
@@ -77,6 +389,13 @@ class BlackboardDataSource(object):
         self.gradecolumn_filename = gradecolumn
         self.specs = specs
         self.options = options if options is not None else {}
+        self.deduplicator = None
+
+    def _option(self, name, default=None):
+        """Return the option ``name`` if the options are a ``dict``, otherwise the ``default``."""
+        if isinstance(self.options, dict):
+            return self.options.get(name, default)
+        return default
 
     def __enter__(self):
         if os.path.isdir('tmp'):
@@ -87,84 +406,292 @@ class BlackboardDataSource(object):
                     os.rmdir(os.path.join(root, name))
         else:
             os.mkdir('tmp')
+        self.submissions = []
+        self.matcher = SpecMatcher(self.specs)
+        self._unwritten = set()
+        self.deduplicator = PartDeduplicator() if self._option('deduplicate', False) else None
+        if self._option('journal') is not None:
+            self.journal = MarkingJournal(self._option('journal'), resume=self._option('resume', False))
+        else:
+            self.journal = None
+        if self._option('instrument') is not None:
+            instrumentation.enable(self._option('instrument'))
+        if self._option('streaming', False):
+            self._stream = self._stream_submissions()
+            return self._stream
+        self._stream = None
+        self.submissions = list(self._load_submissions())
+        return [submission for submission in self.submissions if not submission.completed]
+
+    def _stream_submissions(self):
+        """Generator that loads each :class:`~automarking.core.Submission` only when it is requested
+        and releases its data once the next one is requested. Used when the ``streaming`` option is set."""
+        for submission in self._load_submissions():
+            self.submissions.append(submission)
+            if not submission.completed:
+                yield submission
+                submission.release()
+
+    def _load_submissions(self):
+        """Generator that yields each :class:`~automarking.core.Submission` in the gradebook."""
         studentlist = []
         with open(self.gradecolumn_filename, encoding='utf-8-sig') as in_f:
             reader = DictReader(in_f)
             for line in reader:
                 studentlist.append(line['Student ID'])
-        submissions = []
         with ZipFile(self.gradebook_filename) as in_f:
+            with instrumentation.phase('scan'):
+                index = GradebookIndex.load(self.gradebook_filename, in_f, persist=self._option('persist_index', False))
+            namelist = None
             for studentnr in studentlist:
                 submitted = False
-                for filename in in_f.namelist():
-                    if studentnr in filename:
-                        target_filename = 'tmp/%s%s' % (studentnr, filename[filename.find('.'):])
-                        if filename.lower().endswith('.tar.bz2') or filename.endswith('.tar.gz'):
-                            with in_f.open(filename) as submission_file:
-                                with open(target_filename, 'wb') as out_f:
-                                    out_f.write(submission_file.read())
-                            submissions.append(TarSubmission(studentnr, self.specs, target_filename))
-                            submitted = True
-                        elif filename.lower().endswith('.zip'):
-                            with in_f.open(filename) as submission_file:
-                                with open(target_filename, 'wb') as out_f:
-                                    out_f.write(submission_file.read())
-                            submissions.append(ZipSubmission(studentnr, self.specs, target_filename))
-                            submitted = True
-                        elif filename.lower().endswith('.rar'):
-                            with in_f.open(filename) as submission_file:
-                                with open(target_filename, 'wb') as out_f:
-                                    out_f.write(submission_file.read())
-                            submissions.append(RarSubmission(studentnr, self.specs, target_filename))
-                            submitted = True
-                        elif self.options == "IgnoreFileType":
-                                submissions.append(IgnoreFileType(studentnr, self.specs, target_filename))
-                                submitted = True
-                        elif filename.endswith('.txt'):
-                            pass
-                        else:
-                            submissions.append(MissingSubmission(studentnr, self.specs, message='Unknown submission type %s' % filename[filename.rfind('.'):]))
+                if studentnr in index:
+                    members = [(member.filename, member.type) for member in index.members(studentnr)]
+                else:
+                    # Student IDs that the index does not know fall back to a scan of the gradebook
+                    if namelist is None:
+                        namelist = in_f.namelist()
+                    members = [(filename, submission_type(filename)) for filename in namelist
+                               if studentnr in filename]
+                for filename, type_ in members:
+                    if type_ == 'tar':
+                        yield self._submission(studentnr, in_f, filename, partial(self._open_submission, TarSubmission, studentnr, in_f, filename))
+                        submitted = True
+                    elif type_ == 'zip':
+                        yield self._submission(studentnr, in_f, filename, partial(self._open_submission, ZipSubmission, studentnr, in_f, filename))
+                        submitted = True
+                    elif type_ == 'rar':
+                        yield self._submission(studentnr, in_f, filename, partial(self._open_submission, RarSubmission, studentnr, in_f, filename))
+                        submitted = True
+                    elif self.options == "IgnoreFileType":
+                            target_filename = 'tmp/%s%s' % (studentnr, filename[filename.find('.'):])
+                            yield self._submission(studentnr, in_f, filename, partial(IgnoreFileType, studentnr, self.matcher, target_filename))
                             submitted = True
+                    elif type_ == 'txt':
+                        pass
+                    else:
+                        yield self._submission(studentnr, in_f, filename, partial(MissingSubmission, studentnr, self.specs, message='Unknown submission type %s' % filename[filename.rfind('.'):]))
+                        submitted = True
                 if not submitted:
-                    submissions.append(MissingSubmission(studentnr, self.specs, message=self.options['no_submission_message'] if 'no_submission_message' in self.options else 'No submission'))
-        self.submissions = submissions
-        return self.submissions
+                    yield self._submission(studentnr, in_f, None, partial(MissingSubmission, studentnr, self.specs, message=self.options['no_submission_message'] if 'no_submission_message' in self.options else 'No submission'))
+
+    def _submission(self, studentnr, in_f, filename, factory):
+        """Create the :class:`~automarking.core.Submission` for the gradebook file ``filename`` using the
+        ``factory``. If the journal shows that it has already been marked with the same inputs, then
+        a :class:`~automarking.core.JournalledSubmission` is returned instead."""
+        digest = hashlib.sha256(studentnr.encode('utf-8'))
+        if filename is not None:
+            info = in_f.getinfo(filename)
+            digest.update(('\0%s\0%08x\0%i' % (filename, info.CRC, info.file_size)).encode('utf-8'))
+        for spec in self.specs:
+            digest.update(('\0%s\0%r' % (spec.identifier, spec.pattern)).encode('utf-8'))
+        input_hash = digest.hexdigest()
+        if self.journal is not None:
+            entry = self.journal.completed(studentnr, filename, input_hash)
+            if entry is not None:
+                return JournalledSubmission(studentnr, entry['score'], entry['feedback'])
+        submission = factory()
+        submission.on_complete = self._submission_completed
+        submission.journal_key = filename
+        submission.input_hash = input_hash
+        return submission
+
+    def _open_submission(self, cls, studentnr, in_f, filename):
+        """Open the nested archive ``filename`` straight from the gradebook and load it as a ``cls``
+        :class:`~automarking.core.Submission`. The opened archive is closed when the
+        :class:`~automarking.core.Submission` is released or, if it had to be decompressed and the
+        ``streaming`` option is not set, as soon as the matching files have been read."""
+        with instrumentation.phase('extract', studentnr=studentnr):
+            source = self._open_nested(in_f, filename)
+        with instrumentation.phase('match', studentnr=studentnr):
+            submission = cls(studentnr, self.matcher, source)
+        submission.source = source
+        if isinstance(source, SpooledTemporaryFile) and not self._option('streaming', False):
+            # Without streaming all submissions are loaded up front, so the decompressed archives
+            # would otherwise all be held in memory until the end of the run
+            with instrumentation.phase('extract', studentnr=studentnr):
+                submission.load()
+        return submission
+
+    def _open_nested(self, in_f, filename):
+        """Open the nested archive ``filename`` in the gradebook ``in_f``. Uncompressed members are
+        read directly from the gradebook. Compressed members are decompressed into memory, spilling
+        to disk in ``tmp/`` if they are larger than the ``spool_max_size`` option."""
+        info = in_f.getinfo(filename)
+        if info.compress_type == ZIP_STORED:
+            return in_f.open(info)
+        spool = SpooledTemporaryFile(max_size=self._option('spool_max_size', SPOOL_MAX_SIZE), dir='tmp')
+        with in_f.open(info) as submission_file:
+            shutil.copyfileobj(submission_file, spool)
+        spool.seek(0)
+        return spool
+
+    def _submission_completed(self, submission):
+        """Called by each :class:`~automarking.core.Submission` once it has been marked."""
+        if self.journal is not None:
+            self.journal.record(submission)
+        write_back_every = self._option('write_back_every')
+        if write_back_every:
+            self._unwritten.add(submission.studentnr)
+            if len(self._unwritten) >= write_back_every:
+                self.write_back(self._unwritten)
+                self._unwritten = set()
+
+    def write_back(self, studentnrs=None):
+        """Write the results of the :class:`~automarking.core.Submission`\ s marked so far to the grade
+        column, while marking is still in progress. Only the rows of the marked students are
+        changed.
+
+        :param studentnrs: Only write the results for these students
+        :type studentnrs: ``set``
+        """
+        results = {}
+        for submission in self.submissions:
+            if submission.marked and (studentnrs is None or submission.studentnr in studentnrs):
+                results[submission.studentnr] = (submission.score, submission.feedback)
+        with instrumentation.phase('write_back', students=len(results)):
+            GradeColumn(self.gradecolumn_filename).write(results)
 
     def __exit__(self, type_, value, traceback):
-        submissions = {}
+        if self._stream is not None:
+            self._stream.close()
         for submission in self.submissions:
-            submissions[submission.studentnr] = submission
-        lines = []
-        score_field = None
-        with open(self.gradecolumn_filename, encoding='utf-8-sig') as in_f:
+            submission.release()
+        if self.journal is not None:
+            self.journal.close()
+        results = {}
+        for submission in self.submissions:
+            results[submission.studentnr] = (submission.score, submission.feedback)
+        with instrumentation.phase('write_back', students=len(results)):
+            GradeColumn(self.gradecolumn_filename).write(results, reset_missing=True)
+        if self._option('instrument') is not None:
+            instrumentation.write_summary()
+            instrumentation.disable()
+
+
+class PartDeduplicator(object):
+    """The :class:`~automarking.core.PartDeduplicator` groups the
+    :class:`~automarking.core.SubmissionPart`\ s of the same :class:`~automarking.core.SubmissionSpec`
+    that have identical content (see :meth:`~automarking.core.SubmissionPart.fingerprint`), so that
+    each distinct part is only marked once. The filenames are not taken into account, so marking
+    code that uses the filename in the feedback should not be deduplicated."""
+
+    def __init__(self):
+        self.groups = {}
+        self.results = {}
+
+    def key(self, part):
+        """Return the key identifying the group of the ``part``."""
+        return (part.spec.identifier, part.fingerprint())
+
+    def register(self, key, studentnr):
+        """Add ``studentnr`` to the group ``key``.
+
+        :return: ``True`` if the group has been seen before, ``False`` otherwise
+        :rtype: ``boolean``
+        """
+        seen = key in self.groups
+        self.groups.setdefault(key, []).append(studentnr)
+        return seen
+
+    def record(self, key, part, feedback_length=0):
+        """Record the score and the feedback added after ``feedback_length`` to the ``part`` as the
+        result for the group ``key``."""
+        self.results[key] = (part.score, part.feedback[feedback_length:])
+
+    def apply(self, key, part):
+        """Copy the result for the group ``key`` to the ``part``.
+
+        :return: ``True`` if there was a result for the group, ``False`` otherwise
+        :rtype: ``boolean``
+        """
+        if key not in self.results:
+            return False
+        score, feedback = self.results[key]
+        part.score = score
+        part.feedback.extend(feedback)
+        return True
+
+    def report(self):
+        """Return the groups with more than one member, largest first, as a ``list`` of
+        (spec identifier, group size, ``list`` of student numbers) tuples."""
+        groups = [(key[0], len(studentnrs), studentnrs) for key, studentnrs in self.groups.items()
+                  if len(studentnrs) > 1]
+        groups.sort(key=lambda group: (-group[1], group[0]))
+        return groups
+
+
+class GradeColumn(object):
+    """The :class:`~automarking.core.GradeColumn` writes scores and feedback into the grade column
+    CSV downloaded from Blackboard. The rows are streamed from the existing file into a temporary
+    file next to it, which then atomically replaces the original, so that an interrupted write
+    never leaves a partially written grade column behind."""
+
+    def __init__(self, filename):
+        """:param filename: The filename of the grade column CSV
+        :type filename: ``unicode``
+        """
+        self.filename = filename
+
+    def write(self, results, reset_missing=False):
+        """Write the ``results`` into the grade column.
+
+        :param results: The (score, feedback) for each student number. The feedback is a ``list``
+                        that is joined into lines.
+        :type results: ``dict``
+        :param reset_missing: If ``True``, then students without results get a score of 0.
+                              Otherwise their rows are left unchanged.
+        :type reset_missing: ``boolean``
+        """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with open(self.filename, encoding='utf-8-sig') as in_f:
             reader = DictReader(in_f)
             fieldnames = [fn if fn != 'Feedback to Learner' else 'Feedback to User' for fn in reader.fieldnames]
+            score_field = None
             for fieldname in fieldnames:
                 if 'Total Pts:' in fieldname:
                     score_field = fieldname
-            for line in reader:
-                lines.append(line)
-        with open(self.gradecolumn_filename, 'w', encoding='utf-8-sig') as out_f:
-            writer = DictWriter(out_f, fieldnames=fieldnames)
-            writer.writeheader()
-            for line in lines:
-                if 'Feedback to Learner' in line:
-                    del line['Feedback to Learner']
-                if line['Student ID'] in submissions:
-                    line[score_field] = submissions[line['Student ID']].score
-                    line['Feedback to User'] = '\n'.join(submissions[line['Student ID']].feedback)
-                else:
-                    line[score_field] = 0
-                writer.writerow(line)
+            out_f = NamedTemporaryFile('w', encoding='utf-8-sig', dir=directory, delete=False,
+                                       prefix='.%s.' % os.path.basename(self.filename))
+            try:
+                with out_f:
+                    writer = DictWriter(out_f, fieldnames=fieldnames)
+                    writer.writeheader()
+                    for line in reader:
+                        learner_feedback = line.pop('Feedback to Learner', None)
+                        if line['Student ID'] in results:
+                            score, feedback = results[line['Student ID']]
+                            line[score_field] = score
+                            line['Feedback to User'] = '\n'.join(feedback)
+                        elif reset_missing:
+                            line[score_field] = 0
+                        elif learner_feedback is not None:
+                            line['Feedback to User'] = learner_feedback
+                        writer.writerow(line)
+                    out_f.flush()
+                    os.fsync(out_f.fileno())
+                shutil.copymode(self.filename, out_f.name)
+                os.replace(out_f.name, self.filename)
+            except BaseException:
+                os.remove(out_f.name)
+                raise
 
 
 class Submission(object):
 
+    completed = False
+
     def __init__(self, studentnr):
         self.studentnr = studentnr
         self.score = 0
         self.parts = []
         self.feedback = []
+        self.archive = None
+        self.source = None
+        self.marked = False
+        self.on_complete = None
+        self.journal_key = None
+        self.input_hash = None
 
     def __enter__(self):
         return self.parts
@@ -174,6 +701,45 @@ class Submission(object):
         for part in self.parts:
             self.score = self.score + part.score
             self.feedback.extend(part.feedback)
+        if type_ is None:
+            self.marked = True
+            if self.on_complete is not None:
+                self.on_complete(self)
+
+    def load(self):
+        """Read the data of all :class:`~automarking.core.SubmissionPart`\ s and close the source
+        archive, so that it is not held until the submission is marked."""
+        for part in self.parts:
+            part.load()
+        self._close()
+
+    def release(self):
+        """Release the data held by all :class:`~automarking.core.SubmissionPart`\ s and close the
+        source archive. The score and feedback are kept."""
+        for part in self.parts:
+            part.release()
+        self._close()
+
+    def _close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+
+class JournalledSubmission(Submission):
+    """A :class:`~automarking.core.Submission` that was completed in an earlier run, with the score
+    and feedback restored from the :class:`~automarking.journal.MarkingJournal`."""
+
+    completed = True
+
+    def __init__(self, studentnr, score, feedback):
+        Submission.__init__(self, studentnr)
+        self.marked = True
+        self.score = score
+        self.feedback = feedback
 
 
 class MissingSubmission(Submission):
@@ -187,27 +753,38 @@ class IgnoreFileType(Submission):
     def __init__(self, studentnr, specs, source_filename):
         Submission.__init__(self, studentnr)
         try:
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-             
-                if spec.matches(source_filename):
-                    part.add_data(source_filename, b"")
+            matcher = SpecMatcher.create(specs)
+            self.parts = [SubmissionPart(spec) for spec in matcher.specs]
+            for idx in matcher.match(source_filename):
+                self.parts[idx].add_data(source_filename, b"")
         except Exception as e:
             pass
 
 class TarSubmission(Submission):
+    """A tar submission is read in a single sequential pass, so that compressed archives are only
+    decompressed once. Each file is read as the pass reaches it and added to all
+    :class:`~automarking.core.SubmissionPart`\ s whose spec it matches and whose limits it is
+    within. Files that no spec wants are skipped without being read."""
 
     def __init__(self, studentnr, specs, source_filename):
         Submission.__init__(self, studentnr)
         try:
-            source_file = tarfile.open(source_filename)
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-                for filename in source_file.getnames():
-                    if spec.matches(filename):
-                        part.add_data(filename, source_file.extractfile(filename).read())
+            if isinstance(source_filename, str):
+                source_file = tarfile.open(source_filename, 'r|*')
+            else:
+                source_file = tarfile.open(fileobj=source_filename, mode='r|*')
+            with source_file:
+                matcher = SpecMatcher.create(specs)
+                self.parts = [SubmissionPart(spec) for spec in matcher.specs]
+                for info in source_file:
+                    if info.isfile():
+                        accepted = [idx for idx in matcher.match(info.name)
+                                    if self.parts[idx].accepts(info.name, info.size)]
+                        if accepted:
+                            with source_file.extractfile(info) as member:
+                                data = member.read()
+                            for idx in accepted:
+                                self.parts[idx].add_data(info.name, data)
         except tarfile.TarError:
             pass
 
@@ -218,51 +795,325 @@ class ZipSubmission(Submission):
         Submission.__init__(self, studentnr)
         try:
             source_file = ZipFile(source_filename)
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-                for filename in source_file.namelist():
-                    if spec.matches(filename):
-                        part.add_data(filename, source_file.open(filename).read())
+            self.archive = source_file
+            matcher = SpecMatcher.create(specs)
+            self.parts = [SubmissionPart(spec) for spec in matcher.specs]
+            for info in source_file.infolist():
+                for idx in matcher.match(info.filename):
+                    self.parts[idx].add_member(info.filename, info.file_size, partial(source_file.read, info))
         except BadZipFile:
             pass
 
 
 class RarSubmission(Submission):
+    """Compressed files in a RAR archive can only be read by an external tool (``unrar``, ``unar``,
+    ``7z`` or ``bsdtar``), which :mod:`rarfile` runs once for every file that is read, decompressing
+    a solid archive from its start each time. Instead, the first time that the marking script reads
+    a compressed file, all the files accepted by the specs are extracted by a single run of the
+    tool and kept until the submission is released. Each file is checked against its checksum, and
+    files that the run did not extract correctly are read on their own. Uncompressed files are read
+    directly."""
 
     def __init__(self, studentnr, specs, source_filename):
         Submission.__init__(self, studentnr)
+        self._source_filename = source_filename
+        self._wanted = {}
+        self._extracted = None
         try:
             source_file = RarFile(source_filename)
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-                for filename in source_file.namelist():
-                    filename = filename.replace('\\', '/')
-                    info = source_file.getinfo(filename)
-                    if not info.isdir() and spec.matches(filename):
-                        part.add_data(filename, source_file.open(filename).read())
+            self.archive = source_file
+            matcher = SpecMatcher.create(specs)
+            self.parts = [SubmissionPart(spec) for spec in matcher.specs]
+            for info in source_file.infolist():
+                filename = info.filename.replace('\\', '/')
+                if not info.isdir():
+                    for idx in matcher.match(filename):
+                        if self.parts[idx].add_member(filename, info.file_size, partial(self._read_member, info)):
+                            self._wanted[id(info)] = info
         except BadRarFile:
             pass
         except NotRarFile:
             pass
 
+    def _read_member(self, info):
+        if info.compress_type == RAR_M0 or info.needs_password() or info.file_redir is not None:
+            return self.archive.read(info)
+        if self._extracted is None:
+            try:
+                self._extracted = self._extract()
+            except RarError as error:
+                # Kept, so that the tool is not run again for the submission's other files
+                self._extracted = error
+        if isinstance(self._extracted, RarError):
+            raise self._extracted
+        if id(info) in self._extracted:
+            return self._extracted[id(info)]
+        # Files that the single run of the tool did not extract correctly are read one at a time
+        return self.archive.read(info)
+
+    def _extract(self):
+        """Extract the accepted compressed files with as few runs of the RAR tool as possible, which
+        write them to their output one after the other in the order of the archive. The names are
+        passed on the command-line in batches of at most :data:`RAR_MAX_ARGS` characters.
+
+        :return: The data of the files that were extracted and verified, by ``id`` of their
+                 :class:`~rarfile.RarInfo`
+        :rtype: ``dict``
+        """
+        wanted = [info for info in self._wanted.values()
+                  if info.compress_type != RAR_M0 and not info.needs_password() and info.file_redir is None]
+        batches = []
+        length = RAR_MAX_ARGS
+        for name in sorted(set(info.filename for info in wanted)):
+            if length + len(name) + 1 > RAR_MAX_ARGS:
+                batches.append(set())
+                length = 0
+            batches[-1].add(name)
+            length = length + len(name) + 1
+        extracted = {}
+        try:
+            if isinstance(self._source_filename, str):
+                for names in batches:
+                    extracted.update(self._run_tool(self._source_filename, names))
+            else:
+                # The tool needs the archive as a file
+                with NamedTemporaryFile(dir='tmp', suffix='.rar') as archive_file:
+                    self._source_filename.seek(0)
+                    shutil.copyfileobj(self._source_filename, archive_file)
+                    archive_file.flush()
+                    for names in batches:
+                        extracted.update(self._run_tool(archive_file.name, names))
+        except OSError:
+            # The tool could not be run, so every file is read on its own
+            pass
+        return extracted
+
+    def _run_tool(self, archive_filename, names):
+        """Run the RAR tool once to extract the files with the ``names``. The data of each file is
+        only kept if it matches the checksum in the archive, and none is kept if the output does
+        not end after the last file, as the files could then not be told apart. A tool that runs
+        for longer than :data:`RAR_TOOL_TIMEOUT` seconds is killed and a
+        :class:`~rarfile.BadRarFile` is raised."""
+        # The tool extracts every file with one of the names, in case a name occurs more than once
+        expected = [info for info in self.archive.infolist() if info.is_file() and info.filename in names]
+        setup = tool_setup()
+        cmdline = setup.open_cmdline(None, archive_filename)
+        for name in sorted(names):
+            setup.add_file_arg(cmdline, name.replace('/', os.path.sep))
+        with subprocess.Popen(cmdline, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, start_new_session=True) as process:
+            try:
+                output = process.communicate(timeout=RAR_TOOL_TIMEOUT)[0]
+            except subprocess.TimeoutExpired:
+                # Also kill any processes that the tool started
+                if hasattr(os, 'killpg'):
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except (ProcessLookupError, PermissionError):
+                        pass
+                process.kill()
+                raise BadRarFile('The RAR tool did not finish within %i seconds' % RAR_TOOL_TIMEOUT)
+        extracted = {}
+        position = 0
+        for info in expected:
+            data = output[position:position + info.file_size]
+            if len(data) != info.file_size:
+                return {}
+            if _rar_checksum_matches(info, data):
+                extracted[id(info)] = data
+            position = position + info.file_size
+        if position != len(output):
+            return {}
+        return extracted
+
+    def _close(self):
+        self._extracted = None
+        Submission._close(self)
+
+
+def _rar_checksum_matches(info, data):
+    """Check the ``data`` extracted for the RAR file ``info`` against the CRC32 or BLAKE2sp
+    checksum in the archive. Data without a checksum cannot be verified and does not match."""
+    if info.CRC is not None:
+        return zlib.crc32(data) == info.CRC
+    if info.blake2sp_hash is not None:
+        checksum = Blake2SP()
+        checksum.update(data)
+        return checksum.digest() == info.blake2sp_hash
+    return False
+
+
+class ArchiveMember(BytesIO):
+    """A :class:`~io.BytesIO` that only reads its data from the archive when it is first
+    accessed, so that files the marking script never looks at are never decompressed."""
+
+    def __init__(self, reader, size=None):
+        """:param reader: Function that returns the member's data
+        :type reader: ``callable``
+        :param size: The uncompressed size in bytes, as recorded in the archive
+        :type size: ``int``
+        """
+        BytesIO.__init__(self)
+        self._reader = reader
+        self.size = size
+
+    def _load(self):
+        if self._reader is not None:
+            reader = self._reader
+            self._reader = None
+            BytesIO.write(self, reader())
+            BytesIO.seek(self, 0)
+
+    def read(self, *args):
+        self._load()
+        return BytesIO.read(self, *args)
+
+    def read1(self, *args):
+        self._load()
+        return BytesIO.read1(self, *args)
+
+    def readinto(self, buffer):
+        self._load()
+        return BytesIO.readinto(self, buffer)
+
+    def readline(self, *args):
+        self._load()
+        return BytesIO.readline(self, *args)
+
+    def readlines(self, *args):
+        self._load()
+        return BytesIO.readlines(self, *args)
+
+    def __next__(self):
+        self._load()
+        return BytesIO.__next__(self)
+
+    def getvalue(self):
+        self._load()
+        return BytesIO.getvalue(self)
+
+    def getbuffer(self):
+        self._load()
+        return BytesIO.getbuffer(self)
+
+    def seek(self, *args):
+        self._load()
+        return BytesIO.seek(self, *args)
+
+    def tell(self):
+        self._load()
+        return BytesIO.tell(self)
+
+    def write(self, data):
+        self._load()
+        return BytesIO.write(self, data)
+
+    def truncate(self, *args):
+        self._load()
+        return BytesIO.truncate(self, *args)
+
+    def __getstate__(self):
+        self._load()
+        return BytesIO.__getstate__(self)
+
 
 class SubmissionPart(object):
 
     def __init__(self, spec):
         self.spec = spec
         self.data = None
+        self.total_size = 0
         self.score = 0
         self.feedback = []
+        self.resources = []
 
     def add_data(self, filename, data):
+        self.total_size = self.total_size + len(data)
+        self._append(filename, BytesIO(data))
+
+    def accepts(self, filename, size):
+        """Check whether a file of ``size`` bytes is within the limits of the
+        :class:`~automarking.core.SubmissionSpec`. If not, then the reason is added to the feedback.
+
+        :param filename: The name of the file in the archive
+        :type filename: ``unicode``
+        :param size: The uncompressed size in bytes, as recorded in the archive
+        :type size: ``int``
+        :rtype: ``boolean``
+        """
+        max_member_size = getattr(self.spec, 'max_member_size', None)
+        max_total_size = getattr(self.spec, 'max_total_size', None)
+        if max_member_size is not None and size > max_member_size:
+            self.feedback.append('The file %s (%s) is larger than the maximum of %s and has not been marked'
+                                 % (filename, format_size(size), format_size(max_member_size)))
+            return False
+        elif max_total_size is not None and self.total_size + size > max_total_size:
+            self.feedback.append('The file %s (%s) takes the submission over the maximum total size of %s and has not been marked'
+                                 % (filename, format_size(size), format_size(max_total_size)))
+            return False
+        return True
+
+    def add_member(self, filename, size, reader):
+        """Add an archive member that is only read when the marking script accesses it. If the
+        ``size`` exceeds the limits of the :class:`~automarking.core.SubmissionSpec`, then the
+        member is not added and the reason is added to the feedback.
+
+        :param filename: The name of the member in the archive
+        :type filename: ``unicode``
+        :param size: The uncompressed size in bytes, as recorded in the archive
+        :type size: ``int``
+        :param reader: Function that returns the member's data
+        :type reader: ``callable``
+        :return: Whether the member was added
+        :rtype: ``boolean``
+        """
+        if self.accepts(filename, size):
+            self.total_size = self.total_size + size
+            self._append(filename, ArchiveMember(partial(self._read_member, filename, reader), size))
+            return True
+        return False
+
+    def _read_member(self, filename, reader):
+        """Read the member ``filename`` with its ``reader``. If the archive is corrupt, then the reason
+        is added to the feedback and the member is empty, so that one broken submission does not
+        stop the marking run."""
+        try:
+            return reader()
+        except MEMBER_READ_ERRORS as exception:
+            self.feedback.append('The file %s could not be read (%s) and has not been marked' % (filename, exception))
+            return b''
+
+    def _append(self, filename, data):
         if self.data is None:
-            self.data = (filename, BytesIO(data))
+            self.data = (filename, data)
         elif isinstance(self.data, tuple):
-            self.data = [self.data, (filename, BytesIO(data))]
+            self.data = [self.data, (filename, data)]
         else:
-            self.data.append((filename, BytesIO(data)))
+            self.data.append((filename, data))
+
+    def fingerprint(self):
+        """Calculate a fingerprint of the content of this part. Parts whose files have identical
+        content, in the same order, have the same fingerprint. The filenames are not included.
+
+        :rtype: ``unicode``
+        """
+        digest = hashlib.sha256()
+        if self.data is not None:
+            for _, data in (self.data if isinstance(self.data, list) else [self.data]):
+                digest.update(hashlib.sha256(data.getvalue()).digest())
+        return digest.hexdigest()
+
+    def load(self):
+        """Read the data of all files that have not been read yet, so that it stays available after
+        the source archive is closed."""
+        if self.data is not None:
+            for _, data in (self.data if isinstance(self.data, list) else [self.data]):
+                if isinstance(data, ArchiveMember):
+                    data._load()
+
+    def release(self):
+        """Drop the extracted data, so that it can be garbage collected."""
+        self.data = None
 
     def __enter__(self):
         return self.data
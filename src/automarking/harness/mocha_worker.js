@@ -0,0 +1,273 @@
+/*
+ * Warm mocha worker for automarking.tests.HarnessPool.
+ *
+ * Reads one JSON job per line from stdin ({"id": ..., "args": [...], "cwd": ..., "limits": {...}})
+ * and runs it in a long-lived worker thread that has mocha loaded, so that mocha is only started
+ * once. The "args" are parsed as mocha command-line arguments (options and test files, together
+ * with any .mocharc in "cwd"). Between jobs the worker resets the suite state: every job gets a
+ * new Mocha instance, and the modules, globals and timers that a job added are removed. A job that
+ * is stopped by a limit or exits the process gets a new worker thread. One JSON result per line
+ * ({"id": ..., "returncode": ..., "exit_reason": ..., "stdout": {...}, "stderr": {...}}) is
+ * written to the file descriptor given in the AUTOMARKING_HARNESS_FD environment variable. Only
+ * the first and last "output" / 2 bytes of each stream are kept (base64 encoded in "head" and
+ * "tail", with the total "size"), and a job that prints more than "output" bytes is stopped. The
+ * "memory" limit caps the worker's JavaScript heap. A "cpu" limit cannot be enforced on a thread
+ * and is rejected with an "error" result. Mocha is loaded from MOCHA_PATH if set.
+ */
+'use strict';
+
+const fs = require('fs');
+const path = require('path');
+const readline = require('readline');
+const {Worker, isMainThread, parentPort} = require('worker_threads');
+
+const mochaPath = process.env.MOCHA_PATH || 'mocha';
+
+class BoundedOutput {
+    constructor(limit) {
+        this.limit = limit;
+        this.size = 0;
+        this.head = Buffer.alloc(0);
+        this.tail = Buffer.alloc(0);
+    }
+
+    get truncated() {
+        return this.size > this.limit;
+    }
+
+    feed(chunk) {
+        this.size = this.size + chunk.length;
+        const room = this.limit - Math.floor(this.limit / 2) - this.head.length;
+        if (room > 0) {
+            this.head = Buffer.concat([this.head, chunk.subarray(0, room)]);
+            chunk = chunk.subarray(room);
+        }
+        if (chunk.length > 0) {
+            this.tail = Buffer.concat([this.tail, chunk]);
+            if (this.tail.length > Math.floor(this.limit / 2)) {
+                this.tail = this.tail.subarray(this.tail.length - Math.floor(this.limit / 2));
+            }
+        }
+    }
+
+    toJSON() {
+        return {head: this.head.toString('base64'), tail: this.tail.toString('base64'), size: this.size};
+    }
+}
+
+function mochaModule(name) {
+    return require(mochaPath + '/' + name);
+}
+
+function testFiles(options, cwd) {
+    try {
+        const files = mochaModule('lib/cli/collect-files')(options);
+        return Array.isArray(files) ? files : files.files;
+    } catch (error) {
+        if (error.code !== 'MODULE_NOT_FOUND') {
+            throw error;
+        }
+        return (options.spec || []).map((spec) => path.resolve(cwd, spec));
+    }
+}
+
+/*
+ * Worker thread: loads mocha once and runs the jobs it is sent one after the other.
+ */
+function serveJobs() {
+    const Mocha = require(mochaPath);
+    const loadOptions = mochaModule('lib/cli/options').loadOptions;
+    const modules = new Set(Object.keys(require.cache));
+    const globals = new Set(Object.getOwnPropertyNames(globalThis));
+    const timers = new Set();
+    let current = null;
+
+    // Timers that a job leaves behind are cleared before the next job
+    [['setTimeout', 'clearTimeout'], ['setInterval', 'clearInterval'], ['setImmediate', 'clearImmediate']]
+        .forEach(([set, clear]) => {
+            const original = globalThis[set];
+            const originalClear = globalThis[clear];
+            globalThis[set] = function () {
+                const timer = original.apply(this, arguments);
+                timers.add([originalClear, timer]);
+                return timer;
+            };
+        });
+    ['stdout', 'stderr'].forEach((name) => {
+        process[name].write = (chunk, encoding, callback) => {
+            if (current !== null) {
+                const output = current.outputs[name];
+                output.feed(Buffer.isBuffer(chunk) ? chunk : Buffer.from(String(chunk),
+                                                                        typeof encoding === 'string' ? encoding : 'utf8'));
+                if (output.truncated) {
+                    // The main thread stops this thread as soon as it receives the result
+                    current.finish(1, 'output-limit');
+                }
+            }
+            if (typeof encoding === 'function') {
+                encoding();
+            } else if (typeof callback === 'function') {
+                callback();
+            }
+            return true;
+        };
+    });
+    process.exit = (code) => {
+        if (current !== null) {
+            // The main thread replaces this thread, as the job may have left it in any state
+            current.finish(code === undefined ? process.exitCode || 0 : code, 'exit');
+        }
+    };
+
+    const reset = () => {
+        timers.forEach(([clear, timer]) => clear(timer));
+        timers.clear();
+        Object.keys(require.cache).forEach((name) => {
+            if (!modules.has(name)) {
+                delete require.cache[name];
+            }
+        });
+        Object.getOwnPropertyNames(globalThis).forEach((name) => {
+            if (!globals.has(name)) {
+                delete globalThis[name];
+            }
+        });
+        process.exitCode = undefined;
+    };
+
+    parentPort.on('message', (job) => {
+        let finished = false;
+        let mocha = null;
+        current = {
+            outputs: {stdout: new BoundedOutput(job.limits.output), stderr: new BoundedOutput(job.limits.output)},
+            finish: (returncode, exitReason) => {
+                if (finished) {
+                    return;
+                }
+                finished = true;
+                const job = current;
+                current = null;
+                parentPort.postMessage({returncode: returncode,
+                                        exit_reason: exitReason === 'exit' ? null : exitReason,
+                                        recycle: exitReason !== null,
+                                        stdout: job.outputs.stdout.toJSON(),
+                                        stderr: job.outputs.stderr.toJSON()});
+                if (exitReason === null) {
+                    if (mocha !== null && typeof mocha.dispose === 'function') {
+                        try {
+                            mocha.dispose();
+                        } catch (error) {
+                            // Already disposed by mocha itself
+                        }
+                    }
+                    reset();
+                }
+            },
+        };
+        const finish = current.finish;
+        try {
+            const options = loadOptions(job.args);
+            options.color = false;
+            mocha = new Mocha(options);
+            testFiles(options, job.cwd || process.cwd()).forEach((file) => mocha.addFile(file));
+            mocha.run((failures) => finish(failures ? 1 : 0, null));
+        } catch (error) {
+            process.stderr.write(String(error.stack || error) + '\n');
+            finish(1, null);
+        }
+    });
+}
+
+/*
+ * Main thread: keeps one worker thread with mocha loaded and sends it the jobs.
+ */
+let resultFd = null;
+let worker = null;
+let workerMemory = null;
+
+function startWorker(limits) {
+    const options = {stdout: true, stderr: true};
+    if (limits.memory) {
+        options.resourceLimits = {maxOldGenerationSizeMb: Math.max(1, Math.floor(limits.memory / 1024 / 1024))};
+    }
+    worker = new Worker(__filename, options);
+    workerMemory = limits.memory || null;
+    // Output that bypasses process.stdout / process.stderr is not part of the result
+    worker.stdout.resume();
+    worker.stderr.resume();
+}
+
+function runJob(job) {
+    return new Promise((resolve) => {
+        const write = (result) => {
+            result.id = job.id;
+            fs.writeSync(resultFd, JSON.stringify(result) + '\n');
+            resolve();
+        };
+        const limits = job.limits || {};
+        if (limits.cpu) {
+            write({error: 'The mocha harness cannot limit the CPU time of a test; use the memory and output limits or run the test without a harness'});
+            return;
+        }
+        if (job.cwd) {
+            // Worker threads share the process's working directory
+            process.chdir(job.cwd);
+        }
+        if (worker !== null && workerMemory !== (limits.memory || null)) {
+            worker.terminate();
+            worker = null;
+        }
+        if (worker === null) {
+            startWorker(limits);
+        }
+        const current = worker;
+        const empty = new BoundedOutput(limits.output).toJSON();
+        let done = false;
+        const stop = (result, recycle) => {
+            if (done) {
+                return;
+            }
+            done = true;
+            current.removeAllListeners('message');
+            current.removeAllListeners('error');
+            current.removeAllListeners('exit');
+            if (recycle) {
+                current.terminate();
+                if (worker === current) {
+                    worker = null;
+                }
+            }
+            write(result);
+        };
+        current.on('message', (result) => {
+            const recycle = result.recycle;
+            delete result.recycle;
+            stop(result, recycle);
+        });
+        current.on('error', (error) => {
+            const memory = error.code === 'ERR_WORKER_OUT_OF_MEMORY';
+            const stderr = new BoundedOutput(limits.output);
+            stderr.feed(Buffer.from(String(error.stack || error) + '\n'));
+            stop({returncode: 1, exit_reason: memory ? 'memory-limit' : null, stdout: empty, stderr: stderr.toJSON()},
+                 true);
+        });
+        current.on('exit', (code) => {
+            stop({returncode: code, exit_reason: null, stdout: empty, stderr: empty}, true);
+        });
+        current.postMessage(job);
+    });
+}
+
+if (isMainThread) {
+    resultFd = Number(process.env.AUTOMARKING_HARNESS_FD);
+    const lines = readline.createInterface({input: process.stdin});
+    let jobs = Promise.resolve();
+    lines.on('line', (line) => {
+        jobs = jobs.then(() => runJob(JSON.parse(line)));
+    });
+    lines.on('close', () => {
+        jobs.then(() => process.exit(0));
+    });
+} else {
+    serveJobs();
+}
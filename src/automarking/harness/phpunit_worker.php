@@ -0,0 +1,164 @@
+<?php
+/*
+ * Warm PHPUnit worker for automarking.tests.HarnessPool.
+ *
+ * PHPUnit is loaded once (from the autoloader in PHPUNIT_AUTOLOAD, by default
+ * vendor/autoload.php), and its runner classes are loaded before any job starts. Each JSON job
+ * read from stdin ({"id": ..., "args": [...], "cwd": ..., "limits": {...}}) runs in a forked
+ * child, which inherits the loaded classes, so that student code can never leak into the next
+ * job, with "args" used as the PHPUnit command-line arguments. One JSON result per line
+ * ({"id": ..., "returncode": ..., "exit_reason": ..., "stdout": {...}, "stderr": {...}}) is
+ * written to the file descriptor given in the AUTOMARKING_HARNESS_FD environment variable. Only
+ * the first and last "output" / 2 bytes of stdout and stderr are kept (base64 encoded in "head"
+ * and "tail", with the total "size"), and a job that prints more than "output" bytes to either is
+ * stopped. The "memory" limit sets the child's memory_limit and the "cpu" limit its time limit,
+ * which PHP measures in CPU time. Requires the pcntl and posix extensions.
+ */
+
+require getenv('PHPUNIT_AUTOLOAD') ?: 'vendor/autoload.php';
+
+// Loaded here, rather than in every child, so that the children start with PHPUnit ready to run
+foreach (['PHPUnit\TextUI\Application', 'PHPUnit\TextUI\Command', 'PHPUnit\TextUI\TestRunner',
+          'PHPUnit\TextUI\Configuration\Builder', 'PHPUnit\TextUI\Configuration\Registry',
+          'PHPUnit\TextUI\Help', 'PHPUnit\Framework\TestCase', 'PHPUnit\Framework\TestSuite',
+          'PHPUnit\Framework\TestResult', 'PHPUnit\Framework\Assert', 'PHPUnit\Runner\Version',
+          'PHPUnit\Runner\TestSuiteLoader', 'PHPUnit\Util\Printer',
+          'PHPUnit\TextUI\Output\Default\ResultPrinter', 'PHPUnit\TextUI\DefaultResultPrinter',
+          'PHPUnit\Event\Facade', 'SebastianBergmann\CodeCoverage\CodeCoverage'] as $class) {
+    class_exists($class);
+}
+
+$results = fopen('php://fd/' . getenv('AUTOMARKING_HARNESS_FD'), 'w');
+
+function bounded_output($limit)
+{
+    return ['limit' => $limit, 'size' => 0, 'head' => '', 'tail' => ''];
+}
+
+function feed_output(&$output, $chunk)
+{
+    $output['size'] += strlen($chunk);
+    $half = intdiv($output['limit'], 2);
+    $room = $output['limit'] - $half - strlen($output['head']);
+    if ($room > 0) {
+        $output['head'] .= substr($chunk, 0, $room);
+        $chunk = (string) substr($chunk, $room);
+    }
+    if ($chunk !== '' && $half > 0) {
+        $output['tail'] = (string) substr($output['tail'] . $chunk, -$half);
+    }
+}
+
+function feed_file(&$output, $filename)
+{
+    $in = @fopen($filename, 'rb');
+    if ($in !== false) {
+        while (($chunk = fread($in, 65536)) !== false && $chunk !== '') {
+            feed_output($output, $chunk);
+        }
+        fclose($in);
+    }
+}
+
+function output_json($output)
+{
+    return ['head' => base64_encode($output['head']), 'tail' => base64_encode($output['tail']),
+            'size' => $output['size']];
+}
+
+while (($line = fgets(STDIN)) !== false) {
+    $job = json_decode($line, true);
+    $limits = isset($job['limits']) ? $job['limits'] : [];
+    $resultFile = tempnam(sys_get_temp_dir(), 'automarking');
+    $stderrFile = tempnam(sys_get_temp_dir(), 'automarking');
+    $pid = pcntl_fork();
+    if ($pid === 0) {
+        // The lowest free descriptor is reused, so the file becomes the child's stderr
+        fclose(STDERR);
+        $stderr = fopen($stderrFile, 'wb');
+        ini_set('display_errors', 'stderr');
+        if (!empty($job['cwd'])) {
+            chdir($job['cwd']);
+        }
+        if (!empty($limits['memory'])) {
+            ini_set('memory_limit', (string) $limits['memory']);
+        }
+        if (!empty($limits['cpu'])) {
+            set_time_limit((int) ceil($limits['cpu']));
+        }
+        $returncode = 255;
+        $stdout = bounded_output($limits['output']);
+        $written = false;
+        $writeResult = function ($exitReason) use ($resultFile, &$returncode, &$stdout, &$written) {
+            if (!$written) {
+                $written = true;
+                file_put_contents($resultFile, json_encode(['returncode' => $returncode,
+                                                            'exit_reason' => $exitReason,
+                                                            'stdout' => output_json($stdout)]));
+            }
+        };
+        // Also runs on fatal errors in the student code, which end the child early
+        register_shutdown_function(function () use ($writeResult) {
+            while (ob_get_level() > 0) {
+                ob_end_flush();
+            }
+            $error = error_get_last();
+            $exitReason = null;
+            if ($error !== null && strpos($error['message'], 'Allowed memory size') !== false) {
+                $exitReason = 'memory-limit';
+            } elseif ($error !== null && strpos($error['message'], 'Maximum execution time') !== false) {
+                $exitReason = 'cpu-limit';
+            }
+            $writeResult($exitReason);
+        });
+        ob_start(function ($chunk) use (&$stdout, $writeResult) {
+            feed_output($stdout, $chunk);
+            if ($stdout['size'] > $stdout['limit']) {
+                $writeResult('output-limit');
+                posix_kill(posix_getpid(), SIGKILL);
+            }
+            return '';
+        }, 4096);
+        $argv = array_merge(['phpunit'], $job['args']);
+        $_SERVER['argv'] = $argv;
+        try {
+            if (class_exists('PHPUnit\TextUI\Application')) {
+                $returncode = (new PHPUnit\TextUI\Application())->run($argv);
+            } else {
+                $returncode = PHPUnit\TextUI\Command::main(false);
+            }
+        } catch (Throwable $error) {
+            echo $error;
+            $returncode = 2;
+        }
+        exit(0);
+    }
+    // The child's stderr goes straight to a file, so its size is checked while the child runs
+    $stderrExceeded = false;
+    while (pcntl_waitpid($pid, $status, WNOHANG) === 0) {
+        clearstatcache(true, $stderrFile);
+        if (!$stderrExceeded && @filesize($stderrFile) > $limits['output']) {
+            $stderrExceeded = true;
+            posix_kill($pid, SIGKILL);
+        }
+        usleep(10000);
+    }
+    $result = json_decode((string) @file_get_contents($resultFile), true);
+    @unlink($resultFile);
+    if (!is_array($result)) {
+        $result = ['returncode' => 255, 'exit_reason' => null,
+                   'stdout' => output_json(bounded_output($limits['output']))];
+    }
+    if ($stderrExceeded) {
+        $result['exit_reason'] = 'output-limit';
+    }
+    $stderr = bounded_output($limits['output']);
+    feed_file($stderr, $stderrFile);
+    @unlink($stderrFile);
+    fwrite($results, json_encode(['id' => $job['id'],
+                                  'returncode' => $result['returncode'],
+                                  'exit_reason' => $result['exit_reason'],
+                                  'stdout' => $result['stdout'],
+                                  'stderr' => output_json($stderr)]) . "\n");
+    fflush($results);
+}
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+####################################################
+:mod:`automarking.instrument` -- Run Instrumentation
+####################################################
+
+Timing of the phases of a marking run: scanning the gradebook, extracting and
+matching the nested archives, marking each :class:`~automarking.core.SubmissionPart`,
+running tests and validators, and writing the grade column. Instrumentation is
+disabled by default and then costs a single attribute check per phase. It is
+enabled through the ``instrument`` option of the
+:class:`~automarking.core.BlackboardDataSource` or directly::
+
+    from automarking.instrument import instrumentation
+
+    instrumentation.enable('timings.jsonl')
+    for part, data in mark(source):
+        ...
+    print(instrumentation.report())
+
+Each phase is written to the event log as a JSON line with its ``phase`` name,
+``start`` time, ``duration`` in seconds and any extra fields, such as the
+``studentnr`` and ``spec``. The :meth:`~automarking.instrument.Instrumentation.summary`
+gives the totals per phase, percentiles of the marking time per spec, the
+slowest students and the counters (cache hits and misses, killed orphan
+processes). With :func:`~automarking.mark_parallel` the marking time of each
+part is reported back from the worker processes, but the phases inside the
+workers (tests and validators) are not recorded.
+"""
+import json
+import math
+import os
+import threading
+import time
+
+
+class _NoPhase(object):
+    """The phase used while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+class _Phase(object):
+
+    def __init__(self, instrumentation, name, fields):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.instrumentation.event(self.name, time.perf_counter() - self._start, start=self.start, **self.fields)
+        return False
+
+
+def _percentile(values, percentile):
+    """Return the ``percentile`` of the sorted ``values``, using the nearest rank."""
+    index = max(0, min(len(values) - 1, math.ceil(percentile / 100 * len(values)) - 1))
+    return values[index]
+
+
+class Instrumentation(object):
+    """Collects the timing events of a marking run. Use the module's ``instrumentation`` instance,
+    which the marking functions report to."""
+
+    def __init__(self):
+        self.enabled = False
+        self._out = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all events and counters collected so far."""
+        self.phases = {}
+        self.specs = {}
+        self.students = {}
+        self.counters = {}
+
+    def enable(self, path=None):
+        """Start collecting events.
+
+        :param path: The filename to append the events to as JSON lines. If ``None``, then only
+                     the summary is collected.
+        :type path: ``unicode``
+        """
+        self.disable()
+        if path is not None:
+            # Line buffered, so that forked worker processes do not inherit unwritten events
+            self._out = open(path, 'a', encoding='utf-8', buffering=1)
+        self._pid = os.getpid()
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting events and close the event log."""
+        self.enabled = False
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+    def phase(self, name, **fields):
+        """Return a context manager that times the phase ``name``. The ``fields`` are added to its
+        event; ``studentnr`` and ``spec`` are also used for the summary."""
+        if not self.enabled:
+            return _NO_PHASE
+        return _Phase(self, name, fields)
+
+    def event(self, name, duration, start=None, **fields):
+        """Record a phase ``name`` that took ``duration`` seconds."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._event(name, duration, start, fields)
+
+    def _event(self, name, duration, start, fields):
+        totals = self.phases.setdefault(name, [0, 0.0, 0.0])
+        totals[0] = totals[0] + 1
+        totals[1] = totals[1] + duration
+        totals[2] = max(totals[2], duration)
+        if name == 'mark':
+            if fields.get('spec') is not None:
+                self.specs.setdefault(fields['spec'], []).append(duration)
+            if fields.get('studentnr') is not None:
+                self.students[fields['studentnr']] = self.students.get(fields['studentnr'], 0) + duration
+        if self._out is not None and self._pid == os.getpid():
+            fields['phase'] = name
+            fields['start'] = start if start is not None else time.time() - duration
+            fields['duration'] = duration
+            fields['pid'] = os.getpid()
+            self._out.write(json.dumps(fields) + '\n')
+
+    def count(self, name, value=1):
+        """Add ``value`` to the counter ``name``."""
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, slowest=10):
+        """Summarise the events collected so far.
+
+        :param slowest: The number of slowest students to include
+        :type slowest: ``int``
+        :return: The ``phases`` with their ``count``, ``total`` and ``max`` duration, the ``specs``
+                 with the ``p50``, ``p90``, ``p99`` and ``max`` marking time per part, the
+                 ``slowest`` (studentnr, total marking time) and the ``counters``
+        :rtype: ``dict``
+        """
+        specs = {}
+        for spec, durations in self.specs.items():
+            durations = sorted(durations)
+            specs[spec] = {'count': len(durations),
+                           'p50': _percentile(durations, 50),
+                           'p90': _percentile(durations, 90),
+                           'p99': _percentile(durations, 99),
+                           'max': durations[-1]}
+        return {'phases': dict((name, {'count': totals[0], 'total': totals[1], 'max': totals[2]})
+                               for name, totals in self.phases.items()),
+                'specs': specs,
+                'slowest': sorted(self.students.items(), key=lambda item: item[1], reverse=True)[:slowest],
+                'counters': dict(self.counters)}
+
+    def write_summary(self):
+        """Write the :meth:`~automarking.instrument.Instrumentation.summary` to the event log."""
+        if self._out is not None:
+            self._out.write(json.dumps({'phase': 'summary', 'summary': self.summary()}) + '\n')
+            self._out.flush()
+
+    def report(self, slowest=10):
+        """Format the :meth:`~automarking.instrument.Instrumentation.summary` as text."""
+        summary = self.summary(slowest)
+        lines = ['Phase                 Count      Total        Max']
+        for name, totals in sorted(summary['phases'].items(), key=lambda item: item[1]['total'], reverse=True):
+            lines.append('%-18s %8i %9.3fs %9.3fs' % (name, totals['count'], totals['total'], totals['max']))
+        if summary['specs']:
+            lines.append('')
+            lines.append('Spec                  Count        p50        p90        p99        Max')
+            for spec, stats in sorted(summary['specs'].items()):
+                lines.append('%-18s %8i %9.3fs %9.3fs %9.3fs %9.3fs' % (spec, stats['count'], stats['p50'],
+                                                                      stats['p90'], stats['p99'], stats['max']))
+        if summary['slowest']:
+            lines.append('')
+            lines.append('Slowest students')
+            for studentnr, duration in summary['slowest']:
+                lines.append('%-18s %9.3fs' % (studentnr, duration))
+        if summary['counters']:
+            lines.append('')
+            for name, value in sorted(summary['counters'].items()):
+                lines.append('%-30s %i' % (name, value))
+        return '\n'.join(lines)
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+###################################################
+:mod:`automarking.journal` -- Resumable Marking Runs
+###################################################
+
+The :class:`~automarking.journal.MarkingJournal` records each completed
+:class:`~automarking.core.Submission` as soon as it has been marked, so that a
+run that is interrupted can be resumed without marking those submissions again.
+It is enabled through the ``journal`` and ``resume`` options of the
+:class:`~automarking.core.BlackboardDataSource`.
+"""
+import json
+import os
+
+
+class MarkingJournal(object):
+    """Append-only journal of completed :class:`~automarking.core.Submission`\\ s. Each line is a
+    JSON object with the student number, the gradebook file the submission came from, a hash of
+    the submission's inputs, and the score and feedback. Every line is flushed to disk before the
+    next submission is marked."""
+
+    def __init__(self, path, resume=False):
+        """:param path: The filename of the journal
+        :type path: ``unicode``
+        :param resume: If ``True``, then the existing entries are loaded and new entries are
+                       appended. Otherwise the journal is started afresh.
+        :type resume: ``boolean``
+        """
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as in_f:
+                for line in in_f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Incomplete last line from an interrupted run
+                        continue
+                    self.entries[(entry['studentnr'], entry['key'])] = entry
+        self._out = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def completed(self, studentnr, key, input_hash):
+        """Return the journal entry for the submission ``key`` of ``studentnr`` if it was completed
+        with the same ``input_hash``, otherwise ``None``."""
+        entry = self.entries.get((studentnr, key))
+        if entry is not None and entry['input_hash'] == input_hash:
+            return entry
+        return None
+
+    def record(self, submission):
+        """Record the completed ``submission``."""
+        entry = {'studentnr': submission.studentnr,
+                 'key': submission.journal_key,
+                 'input_hash': submission.input_hash,
+                 'score': submission.score,
+                 'feedback': submission.feedback}
+        self.entries[(entry['studentnr'], entry['key'])] = entry
+        self._out.write(json.dumps(entry) + '\n')
+        self._out.flush()
+        os.fsync(self._out.fileno())
+
+    def close(self):
+        self._out.close()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+#####################################################
+:mod:`automarking.parsers` -- Structured Test Results
+#####################################################
+
+Parsers for the machine-readable output of the test frameworks, which turn it
+into a list of :class:`~automarking.parsers.TestCaseResult`\\ s. Pass the name
+of a parser to :func:`~automarking.tests.run_test` using the ``parser``
+parameter, together with the reporter option for the framework:
+
+============== ============================================================
+Parser         Test command
+============== ============================================================
+``junit``      ``phpunit --log-junit report.xml`` (with ``report='report.xml'``)
+``tap``        ``mocha --reporter tap`` or any other TAP producer
+``mocha-json`` ``mocha --reporter json``
+``jest-json``  ``jest --json``
+============== ============================================================
+
+Additional parsers can be added with :func:`~automarking.parsers.register_parser`.
+"""
+import json
+import re
+
+from xml.etree import ElementTree
+
+PARSERS = {}
+
+TAP_LINE = re.compile(r'^(not )?ok\b\s*(?:\d+)?\s*(?:- )?([^#\n]*?)\s*(?:#\s*(SKIP|TODO)\S*\s*(.*))?$',
+                      re.MULTILINE | re.IGNORECASE)
+TAP_DIAGNOSTIC = re.compile(r'^\s+(?:message: |# )?(.*)$')
+MOCHA_JSON_START = re.compile(r'^\{\s*"stats"', re.MULTILINE)
+JEST_JSON_START = re.compile(r'^\{\s*"numFailedTestSuites"', re.MULTILINE)
+
+
+class TestCaseResult(object):
+    """The result of a single test case."""
+
+    PASSED = 'passed'
+    FAILED = 'failed'
+    ERROR = 'error'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, status, message='', duration=None):
+        """:param name: The full name of the test case
+        :type name: ``unicode``
+        :param status: One of ``passed``, ``failed``, ``error`` or ``skipped``
+        :type status: ``unicode``
+        :param message: The failure message
+        :type message: ``unicode``
+        :param duration: The time the test case took in seconds, if known
+        :type duration: ``float``
+        """
+        self.name = name
+        self.status = status
+        self.message = message
+        self.duration = duration
+
+    @property
+    def passed(self):
+        return self.status == TestCaseResult.PASSED
+
+    def __repr__(self):
+        return 'TestCaseResult(%r, %r)' % (self.name, self.status)
+
+
+def register_parser(name):
+    """Decorator that registers a parser under the ``name``. A parser is called with the decoded
+    ``stdout`` and ``stderr`` of the test and the content of the ``report`` file (or ``None``), and
+    returns a list of :class:`~automarking.parsers.TestCaseResult`\\ s, or ``None`` if the output is
+    not in its format."""
+    def register(parser):
+        PARSERS[name] = parser
+        return parser
+    return register
+
+
+def get_parser(parser):
+    """Return the parser registered as ``parser``, or ``parser`` itself if it is a function."""
+    if callable(parser):
+        return parser
+    try:
+        return PARSERS[parser]
+    except KeyError:
+        raise ValueError('Unknown test result parser %r' % parser)
+
+
+@register_parser('junit')
+def parse_junit(stdout, stderr, report=None):
+    """Parse JUnit XML, as written by PHPUnit's ``--log-junit`` and the mocha and jest JUnit
+    reporters, from the ``report`` or, if there is none, from ``stdout``."""
+    text = report if report is not None else stdout
+    start = text.find('<')
+    if start < 0:
+        return None
+    try:
+        root = ElementTree.fromstring(text[start:].encode('utf-8'))
+    except ElementTree.ParseError:
+        return None
+    results = []
+    for case in root.iter('testcase'):
+        name = case.get('name', '')
+        if case.get('classname'):
+            name = '%s::%s' % (case.get('classname'), name)
+        status = TestCaseResult.PASSED
+        message = ''
+        for child in case:
+            if child.tag in ('failure', 'error', 'skipped'):
+                status = {'failure': TestCaseResult.FAILED,
+                          'error': TestCaseResult.ERROR,
+                          'skipped': TestCaseResult.SKIPPED}[child.tag]
+                message = child.get('message') or child.text or ''
+                break
+        try:
+            duration = float(case.get('time'))
+        except (TypeError, ValueError):
+            duration = None
+        results.append(TestCaseResult(name, status, message, duration))
+    return results
+
+
+@register_parser('tap')
+def parse_tap(stdout, stderr, report=None):
+    """Parse the Test Anything Protocol. Indented lines after a failing test are used as its
+    message."""
+    text = report if report is not None else stdout
+    results = []
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        match = TAP_LINE.match(line)
+        if match is None:
+            continue
+        if match.group(3):
+            status = TestCaseResult.SKIPPED
+        elif match.group(1):
+            status = TestCaseResult.FAILED
+        else:
+            status = TestCaseResult.PASSED
+        message = ''
+        if status == TestCaseResult.FAILED:
+            diagnostics = []
+            for diagnostic in lines[index + 1:]:
+                diagnostic_match = TAP_DIAGNOSTIC.match(diagnostic)
+                if diagnostic_match is None or TAP_LINE.match(diagnostic):
+                    break
+                if diagnostic_match.group(1).strip() not in ('', '---', '...'):
+                    diagnostics.append(diagnostic_match.group(1).strip())
+            message = '\n'.join(diagnostics)
+        results.append(TestCaseResult(match.group(2), status, message))
+    return results if results else None
+
+
+def _load_json(text, start_pattern):
+    """Load the JSON object that starts at the ``start_pattern`` in ``text``, ignoring anything that
+    the submission printed before or after it."""
+    match = start_pattern.search(text)
+    if match is None:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, match.start())
+    except ValueError:
+        return None
+    return value
+
+
+@register_parser('mocha-json')
+def parse_mocha_json(stdout, stderr, report=None):
+    """Parse the output of mocha's ``json`` reporter."""
+    value = _load_json(report if report is not None else stdout, MOCHA_JSON_START)
+    if value is None:
+        return None
+    results = []
+    for key, status in (('passes', TestCaseResult.PASSED),
+                        ('failures', TestCaseResult.FAILED),
+                        ('pending', TestCaseResult.SKIPPED)):
+        for test in value.get(key, []):
+            message = (test.get('err') or {}).get('message', '')
+            duration = test.get('duration') / 1000 if test.get('duration') is not None else None
+            results.append(TestCaseResult(test.get('fullTitle', test.get('title', '')), status, message, duration))
+    return results
+
+
+@register_parser('jest-json')
+def parse_jest_json(stdout, stderr, report=None):
+    """Parse the output of ``jest --json``. A test file that failed to run counts as one error."""
+    value = _load_json(report if report is not None else stdout, JEST_JSON_START)
+    if value is None:
+        return None
+    statuses = {'passed': TestCaseResult.PASSED,
+                'failed': TestCaseResult.FAILED,
+                'pending': TestCaseResult.SKIPPED,
+                'skipped': TestCaseResult.SKIPPED,
+                'todo': TestCaseResult.SKIPPED,
+                'disabled': TestCaseResult.SKIPPED}
+    results = []
+    for suite in value.get('testResults', []):
+        assertions = suite.get('assertionResults', [])
+        if not assertions and suite.get('status') == 'failed':
+            results.append(TestCaseResult(suite.get('name', ''), TestCaseResult.ERROR, suite.get('message', '')))
+        for test in assertions:
+            message = '\n'.join(test.get('failureMessages') or [])
+            duration = test.get('duration') / 1000 if test.get('duration') is not None else None
+            results.append(TestCaseResult(test.get('fullName', test.get('title', '')),
+                                          statuses.get(test.get('status'), TestCaseResult.ERROR),
+                                          message, duration))
+    return results
+
@@ -6,14 +6,48 @@
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>, Dan Campbell <danielcampbell2097@hotmail.com>
 """
+import asyncio
+import base64
+import http.client
+import itertools
 import json
+import os
+import queue
 import re
+import select
+import signal
+import socket
+import tempfile
+import threading
+import time
 import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import StringIO, BytesIO
-from subprocess import Popen, PIPE, TimeoutExpired
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+
+from .core import format_size
+from .instrument import instrumentation
+from .parsers import TestCaseResult, get_parser
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 HTML_VALIDATOR_URL = "https://teaching.computing.edgehill.ac.uk/validator/html?"
 CSS_VALIDATOR_URL = "https://teaching.computing.edgehill.ac.uk/validator/css/validator?"
+DEFAULT_OUTPUT_LIMIT = 1024 * 1024
+VALIDATION_TIMEOUT = 'Validation failed due to timeout'
+VALIDATOR_UNAVAILABLE = 'Validation failed because the validator is unavailable'
+PHP_ERROR = re.compile(r'Error: (.+?)\n')
+PHP_FATAL_ERROR = re.compile(r'PHP Fatal error: (.+?) in (.+?) ')
+PHPUNIT_FAILURE = re.compile(r'(There was \d (error|failure):)[\s\S]([\w\s]*.*){1,2}', re.MULTILINE)
+PHPUNIT_TEST_NAME = re.compile(r'\d\)\s{1,}question_\d{1,}::test')
+JS_ERROR_LINE = re.compile(r'(^.*\wError:*.*)', re.MULTILINE)
+JS_ERROR = re.compile(r'.*Error+.*')
+OUT_OF_MEMORY = re.compile(r'out of memory|Allowed memory size|MemoryError|Cannot allocate memory|allocation failed', re.IGNORECASE)
 
 def format_feedback(feedback, start_tag='\t<li>', end_tag='</li>',):
     return f"{start_tag}{feedback}{end_tag}"
@@ -59,123 +93,934 @@ def merge_code(base, overlay, start_identifier='// StartStudentCode', end_identi
     return '\n'.join([pre, code, post])
 
 
-def run_test(command, parameters, submission_file, timeout=60, correct_points=4, attempt_points=2, simple=False):
+def run_test(command, parameters, submission_file, timeout=60, correct_points=4, attempt_points=2, simple=False, cache=None, harness=None, limits=None,
+             parser=None, report=None, partial_credit=False):
+    """Run the test ``command`` with the ``parameters`` and set the score and feedback of the
+    ``submission_file`` from its output. If a ``cache`` is given, then results for unchanged
+    submissions and tests are taken from the cache instead of running the test again.
+
+    :param cache: The cache of previous test results
+    :type cache: :class:`~automarking.cache.TestResultCache`
+    :param harness: Run the test on this pool of warm harness processes instead of starting the
+                    ``command``. Defaults to the ``harness`` of the ``submission_file``'s spec.
+    :type harness: :class:`~automarking.tests.HarnessPool`
+    :param limits: Resource limits for the test process: ``cpu`` time in seconds, ``memory``
+                   (data segment size) in bytes and ``output`` size in bytes for each of stdout
+                   and stderr (default 1MB). A test that exceeds the ``output`` limit is stopped,
+                   and only the start and end of its output are kept. The resources that the test
+                   used are appended to the ``submission_file``'s ``resources``.
+    :type limits: ``dict``
+    :param parser: The name of the :mod:`~automarking.parsers` parser for the test's output, or a
+                   parser function. The score and feedback are then set from the individual test
+                   cases. If the output cannot be parsed, then it is handled as without a parser.
+    :type parser: ``unicode``
+    :param report: The filename of the report that the test writes (for example with PHPUnit's
+                   ``--log-junit``), which is given to the ``parser`` instead of the test's output
+    :type report: ``unicode``
+    :param partial_credit: Award a share of the marks for each test case that passed
+    :type partial_credit: ``boolean``
+    """
+    if harness is None:
+        harness = getattr(submission_file.spec, 'harness', None)
+    if cache is not None:
+        key = cache.key(submission_file, command, parameters, timeout, correct_points, attempt_points, simple, limits,
+                        getattr(parser, '__name__', parser), partial_credit)
+        if cache.apply(key, submission_file):
+            return
+        score, feedback_length = submission_file.score, len(submission_file.feedback)
+    _remove_report(report)
+
+    if harness is not None:
+        start = time.monotonic()
+        result = harness.run(parameters, timeout, limits=limits)
+        usage = _harness_usage(start, result, limits)
+        _record_usage(submission_file, usage)
+        if result is not None:
+            _score_test(submission_file, result[0], result[1], result[2], usage, limits, correct_points,
+                        attempt_points, simple, parser, report, partial_credit)
+            if cache is not None:
+                cache.record(key, submission_file, score, feedback_length)
+        return
+
+    returncode, stdout, stderr, usage = _run_process(command, parameters, timeout, limits)
+    _record_usage(submission_file, usage)
+    if returncode is not None:
+        _score_test(submission_file, returncode, stdout, stderr, usage, limits, correct_points, attempt_points,
+                    simple, parser, report, partial_credit)
+        if cache is not None:
+            cache.record(key, submission_file, score, feedback_length)
+
 
-    with Popen([command] + parameters, stdout=PIPE, stderr=PIPE) as process:
+def _peak_rss(pid):
+    """Return the peak memory use of the running process ``pid`` in bytes, or ``None`` if it cannot
+    be read. Unlike the ``ru_maxrss`` of the process, this does not include the memory it shared
+    with its parent before it started the test command."""
+    try:
+        with open('/proc/%i/status' % pid, 'rb') as in_f:
+            for line in in_f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reap(process, deadline):
+    """Wait until the test ``process`` exits or the ``deadline`` passes. The process is reaped here,
+    rather than by :meth:`~subprocess.Popen.wait`, so that its resource usage is kept, and its peak
+    memory is sampled while it runs.
+
+    :return: (exited, returncode, rusage, peak_rss). The returncode is only taken from the wait
+             status of the process, and is ``None`` if it is not known. The rusage and peak_rss
+             are ``None`` if they are not available.
+    :rtype: ``tuple``
+    """
+    if not hasattr(os, 'wait4'):
+        try:
+            process.wait(max(0, deadline - time.monotonic()))
+        except TimeoutExpired:
+            return (False, None, None, None)
+        return (True, process.returncode, None, None)
+    peak_rss = None
+    delay = 0.0005
+    while True:
+        sample = _peak_rss(process.pid)
+        if sample is not None:
+            peak_rss = max(peak_rss or 0, sample)
         try:
+            (pid, status, rusage) = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Reaped elsewhere, so neither the exit status nor the usage are known
+            return (True, None, None, peak_rss)
+        if pid == process.pid:
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            # Stops Popen from waiting for the process again
+            process.returncode = returncode
+            return (True, returncode, rusage, peak_rss)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return (False, None, None, peak_rss)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
 
-            stdout, stderr = process.communicate(timeout=timeout)
-            stdout = stdout.decode('utf-8').replace("#StandWithUkraine", "")
-            stderr = stderr.decode('utf-8').replace('#StandWithUkraine', "")  
-
-            if 'at reverse (merge' in stdout:
-                stdout= 'RangeError: Maximum call stack size exceeded. Your code just keeps adding function calls to the stack\n'
-            elif 'An error occurred inside PHPUnit.' in stdout:
-                stdout= " There is an error inside your code which has caused PHP Unit to catch an error"
-            
-            if simple:
+
+def _resource_limits(limits):
+    """Return the (resource, (soft, hard)) pairs for the ``cpu`` (seconds) and ``memory`` (bytes)
+    ``limits`` of a test process."""
+    rlimits = []
+    if resource is not None and limits.get('cpu'):
+        rlimits.append((resource.RLIMIT_CPU, (limits['cpu'], limits['cpu'] + 1)))
+    if resource is not None and limits.get('memory'):
+        rlimits.append((resource.RLIMIT_DATA, (limits['memory'], limits['memory'])))
+    return rlimits
+
+
+def _resource_limiter(limits):
+    """Return a function that applies the ``limits`` in the test process, or ``None`` if there are no
+    such limits or they can be applied with :func:`_apply_limits` instead. Running Python code
+    between fork and exec is not safe in a program with threads, so this is only used where
+    :func:`resource.prlimit` is not available."""
+    rlimits = _resource_limits(limits)
+    if not rlimits or hasattr(resource, 'prlimit'):
+        return None
+
+    def set_limits():
+        for rlimit, values in rlimits:
+            resource.setrlimit(rlimit, values)
+    return set_limits
+
+
+def _apply_limits(pid, limits, kill):
+    """Apply the ``limits`` to the test process ``pid`` that has just been started. The process runs
+    without them for the short time until they are set, but the CPU time that it uses in the
+    meantime still counts towards the ``cpu`` limit. If the limits cannot be set, the process is
+    stopped with ``kill`` and the error raised."""
+    if not hasattr(resource, 'prlimit'):
+        return
+    try:
+        for rlimit, values in _resource_limits(limits):
+            resource.prlimit(pid, rlimit, values)
+    except ProcessLookupError:
+        # Already exited
+        pass
+    except (OSError, ValueError):
+        kill()
+        raise
+
+
+def _utf8_head(data):
+    """Remove an incomplete UTF-8 character from the end of ``data``."""
+    for index in range(1, min(4, len(data)) + 1):
+        byte = data[-index]
+        if byte & 0xC0 != 0x80:
+            length = 1 if byte < 0x80 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return data[:-index] if length > index else data
+    return data
+
+
+def _utf8_tail(data):
+    """Remove an incomplete UTF-8 character from the start of ``data``."""
+    index = 0
+    while index < min(3, len(data)) and data[index] & 0xC0 == 0x80:
+        index = index + 1
+    return data[index:]
+
+
+class _BoundedOutput(object):
+    """Captures one output stream of a test process, keeping only the first and last
+    ``limit / 2`` bytes, so that the memory used does not depend on how much the test prints. When
+    the output exceeds the ``limit``, ``on_exceeded`` is called (to stop the process) and the rest
+    of the output is read and discarded."""
+
+    def __init__(self, limit, on_exceeded=None):
+        self.limit = limit
+        self.on_exceeded = on_exceeded
+        self.size = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+
+    @property
+    def truncated(self):
+        return self.size > self.limit
+
+    def feed(self, chunk):
+        self.size = self.size + len(chunk)
+        room = self.limit - self.limit // 2 - len(self.head)
+        if room > 0:
+            self.head.extend(chunk[:room])
+            chunk = chunk[room:]
+        if chunk:
+            self.tail.extend(chunk)
+            if len(self.tail) > self.limit // 2:
+                del self.tail[:len(self.tail) - self.limit // 2]
+        if self.size - len(chunk) <= self.limit < self.size and self.on_exceeded is not None:
+            self.on_exceeded()
+
+    def read_from(self, stream, stopped):
+        """Read the ``stream`` until it is closed or the ``stopped`` event is set, and then close
+        it. The stream is only closed here, so that it cannot be closed while it is being read."""
+        fd = stream.fileno()
+        try:
+            while not stopped.is_set():
+                try:
+                    if not select.select([fd], [], [], 0.1)[0]:
+                        continue
+                    chunk = os.read(fd, 65536)
+                except (OSError, ValueError):
+                    break
+                if not chunk:
+                    break
+                self.feed(chunk)
+        finally:
+            stream.close()
+
+    def getvalue(self):
+        if not self.truncated:
+            return bytes(self.head + self.tail)
+        head = _utf8_head(bytes(self.head))
+        tail = _utf8_tail(bytes(self.tail))
+        return head + b'\n[... %i bytes of output omitted ...]\n' % (self.size - len(head) - len(tail)) + tail
+
+
+def _process_group(pgid):
+    """Return the pids of the running processes in the process group ``pgid``, or ``None`` if they
+    cannot be listed."""
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    members = []
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name, 'rb') as in_f:
+                stat = in_f.read()
+        except OSError:
+            continue
+        # The fields after the command name are the state, the parent pid and the process group
+        fields = stat[stat.rindex(b')') + 2:].split()
+        if int(fields[2]) == pgid and fields[0] != b'Z':
+            members.append(int(name))
+    return members
+
+
+def _kill_process_group(pgid, exclude=None):
+    """Kill all processes in the process group ``pgid``, which the test processes are started in,
+    so that no processes they started are left running.
+
+    :return: The pids of the processes that were killed, not including the ``exclude`` pid
+    :rtype: ``set``
+    """
+    if not hasattr(os, 'killpg'):
+        return set()
+    members = _process_group(pgid)
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        return set()
+    if members is None:
+        # The processes cannot be listed, but at least one was left
+        return set([None])
+    return set(members) - set([exclude])
+
+
+def _usage(command, start, returncode, rusage, limits, timed_out=False, truncated=False, stderr=b'', orphans=0,
+           exit_reason=None, peak_rss=None):
+    """Create the resource accounting record for a single test. The ``exit_reason`` is derived from
+    the other parameters unless it is given. A test only counts as stopped by the ``memory`` limit
+    if it reported a failed allocation, as its peak memory is only sampled and cannot tell a test
+    that ran out of memory from one that failed while using a lot of it."""
+    cpu_time = rusage.ru_utime + rusage.ru_stime if rusage is not None else None
+    if timed_out:
+        exit_reason = 'timeout'
+    elif exit_reason is not None:
+        pass
+    elif truncated:
+        exit_reason = 'output-limit'
+    elif limits.get('cpu') and (returncode == -getattr(signal, 'SIGXCPU', -1) or
+                                (returncode is not None and returncode < 0 and cpu_time is not None and cpu_time >= limits['cpu'])):
+        exit_reason = 'cpu-limit'
+    elif limits.get('memory') and returncode != 0 and OUT_OF_MEMORY.search(stderr.decode('utf-8', errors='replace')):
+        exit_reason = 'memory-limit'
+    elif returncode is not None and returncode < 0:
+        exit_reason = 'signal'
+    else:
+        exit_reason = 'exit'
+    return {'command': os.path.basename(command),
+            'wall_time': time.monotonic() - start,
+            'cpu_time': cpu_time,
+            'peak_rss': peak_rss,
+            'returncode': returncode,
+            'exit_reason': exit_reason,
+            'orphans': orphans}
+
+
+def _run_process(command, parameters, timeout, limits=None):
+    """Run the test process and return (returncode, stdout, stderr, usage). The returncode, stdout and
+    stderr are ``None`` if the process timed out. The output is read while the process runs, and the
+    process is stopped as soon as either stream exceeds the ``output`` limit. When the process
+    exits, any processes that it left running are killed."""
+    limits = limits if limits is not None else {}
+    max_output = limits.get('output', DEFAULT_OUTPUT_LIMIT)
+    start = time.monotonic()
+    deadline = start + timeout
+    orphans = set()
+    with Popen([command] + parameters, stdout=PIPE, stderr=PIPE, preexec_fn=_resource_limiter(limits),
+               start_new_session=True) as process:
+
+        def stop():
+            # Only signals the process group, as Popen.kill() may reap the process before _reap does
+            orphans.update(_kill_process_group(process.pid, exclude=process.pid))
+            if not hasattr(os, 'killpg'):
+                # Popen is the only one to reap the process here
+                process.kill()
+
+        # The process is not reaped before _reap, so its pid cannot have been reused
+        _apply_limits(process.pid, limits, stop)
+
+        outputs = [_BoundedOutput(max_output, stop), _BoundedOutput(max_output, stop)]
+        stopped = threading.Event()
+        readers = [threading.Thread(target=output.read_from, args=(stream, stopped), daemon=True)
+                   for output, stream in zip(outputs, [process.stdout, process.stderr])]
+        # The readers close the pipes, so Popen must not close them when the readers are still running
+        process.stdout = process.stderr = None
+        for reader in readers:
+            reader.start()
+        (exited, returncode, rusage, peak_rss) = _reap(process, deadline)
+        timed_out = not exited
+        # Processes that the test left running would otherwise hold the pipes open
+        stop()
+        if timed_out:
+            (_, returncode, rusage, _) = _reap(process, time.monotonic() + 1)
+        else:
+            grace = time.monotonic() + 1
+            for reader in readers:
+                reader.join(max(0, grace - time.monotonic()))
+        # A process that left the process group may still hold the pipes open, and the output read
+        # until then is the test's output
+        stopped.set()
+        for reader in readers:
+            reader.join(1)
+    orphans = len(orphans | _kill_process_group(process.pid))
+    if timed_out:
+        return (None, None, None, _usage(command, start, returncode, rusage, limits, timed_out=True,
+                                         orphans=orphans, peak_rss=peak_rss))
+    stdout, stderr = [output.getvalue() for output in outputs]
+    truncated = any(output.truncated for output in outputs)
+    return (returncode, stdout, stderr,
+            _usage(command, start, returncode, rusage, limits, truncated=truncated, stderr=stderr,
+                   orphans=orphans, peak_rss=peak_rss))
+
+
+def _harness_usage(start, result, limits):
+    """Create the resource accounting record for a test run on a :class:`~automarking.tests.HarnessPool`."""
+    return _usage('harness', start, result[0] if result is not None else None, None, limits or {},
+                  timed_out=result is None, exit_reason=result[3] if result is not None else None)
+
+
+def _score_test(submission_file, returncode, stdout, stderr, usage, limits, correct_points, attempt_points, simple,
+                parser, report, partial_credit):
+    """Set the score and feedback of the ``submission_file`` from a test that ran to its end. A test
+    that was stopped because it printed too much never passed, whatever its output and exit status
+    were, so it is only awarded the ``attempt_points``."""
+    if usage['exit_reason'] == 'output-limit':
+        max_output = (limits or {}).get('output', DEFAULT_OUTPUT_LIMIT)
+        submission_file.score = attempt_points
+        submission_file.feedback.append(format_feedback('The test was stopped because its output exceeded %s.'
+                                                        % format_size(max_output)))
+        submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
+    else:
+        _score_output(submission_file, returncode, stdout, stderr, correct_points, attempt_points, simple, parser,
+                      report, partial_credit)
+
+
+def _record_usage(submission_file, usage):
+    """Add the ``usage`` of a test to the ``submission_file``'s ``resources`` and report it to the
+    :mod:`~automarking.instrument` instrumentation."""
+    submission_file.resources.append(usage)
+    if instrumentation.enabled:
+        instrumentation.event('test', usage['wall_time'], command=usage['command'],
+                              spec=submission_file.spec.identifier, exit_reason=usage['exit_reason'])
+        instrumentation.count('exit_reason.%s' % usage['exit_reason'])
+        instrumentation.count('orphans', usage['orphans'])
+
+
+def _remove_report(report):
+    """Remove the report left by a previous test, so that it is not taken for this test's report."""
+    if report is not None and os.path.exists(report):
+        os.unlink(report)
+
+
+def parse_test_output(parser, stdout, stderr, report=None):
+    """Parse the output of a test with the ``parser``.
+
+    :param parser: The name of a registered parser or a parser function
+    :param stdout: The test's stdout
+    :type stdout: ``bytes``
+    :param stderr: The test's stderr
+    :type stderr: ``bytes``
+    :param report: The filename of the report that the test wrote
+    :type report: ``unicode``
+    :return: The test case results or ``None`` if the output could not be parsed
+    :rtype: ``list`` of :class:`~automarking.parsers.TestCaseResult`
+    """
+    report_content = None
+    if report is not None:
+        if not os.path.exists(report):
+            return None
+        with open(report, 'rb') as in_f:
+            report_content = in_f.read().decode('utf-8', errors='replace')
+    return get_parser(parser)(stdout.decode('utf-8', errors='replace'), stderr.decode('utf-8', errors='replace'),
+                              report_content)
+
+
+def score_results(submission_file, results, correct_points=4, attempt_points=2, partial_credit=False):
+    """Set the score and feedback of the ``submission_file`` from the test case ``results``. If all
+    test cases passed, then the score is ``correct_points``, otherwise it is ``attempt_points``. With
+    ``partial_credit``, each test case that passed adds its share of the difference between the
+    two. Skipped test cases are not counted."""
+    counted = [result for result in results if result.status != TestCaseResult.SKIPPED]
+    passed = len([result for result in counted if result.passed])
+    if counted and passed == len(counted):
+        submission_file.score = correct_points
+    elif partial_credit and counted:
+        submission_file.score = round(attempt_points + (correct_points - attempt_points) * passed / len(counted), 2)
+    else:
+        submission_file.score = attempt_points
+    submission_file.feedback.append(format_feedback(f"{passed} of {len(counted)} tests passed"))
+    for result in counted:
+        if not result.passed:
+            message = result.message.strip().split('\n', 1)[0]
+            submission_file.feedback.append(format_feedback(f"{result.name}: {message}" if message else result.name))
+    submission_file.feedback.append(format_feedback(f"You have been awarded {submission_file.score} marks"))
+
+
+def _score_output(submission_file, returncode, stdout, stderr, correct_points, attempt_points, simple, parser, report,
+                  partial_credit):
+    results = parse_test_output(parser, stdout, stderr, report) if parser is not None else None
+    if results:
+        score_results(submission_file, results, correct_points, attempt_points, partial_credit)
+    else:
+        process_test_output(submission_file, returncode, stdout, stderr, correct_points, attempt_points, simple)
+
+
+def process_test_output(submission_file, returncode, stdout, stderr, correct_points=4, attempt_points=2, simple=False):
+    """Set the score and feedback of the ``submission_file`` from the output of a test process.
+    Used by :func:`~automarking.tests.run_test` and :func:`~automarking.tests.run_test_async`."""
+    stdout = stdout.decode('utf-8').replace("#StandWithUkraine", "")
+    stderr = stderr.decode('utf-8').replace('#StandWithUkraine', "")  
+
+    if 'at reverse (merge' in stdout:
+        stdout= 'RangeError: Maximum call stack size exceeded. Your code just keeps adding function calls to the stack\n'
+    elif 'An error occurred inside PHPUnit.' in stdout:
+        stdout= " There is an error inside your code which has caused PHP Unit to catch an error"
+    
+    if simple:
+        
+        # Order of this list is important for the feedback!
+        console_streams = [stderr, stdout]
+        for stream in console_streams:
+            if not not stream: 
+                if submission_file.spec.identifier.endswith('.php'): # Handle PHPUnit Output
                 
-                # Order of this list is important for the feedback!
-                console_streams = [stderr, stdout]
-                for stream in console_streams:
-                    if not not stream: 
-                        if submission_file.spec.identifier.endswith('.php'): # Handle PHPUnit Output
+                    if'OK' in stream: # PASS
+                        stdout = "PHP Unit: Test Passed"
+                        submission_file.score = correct_points
+                        submission_file.feedback.append(format_feedback(stdout)) 
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {correct_points} marks for an attempt and for passing the unit test/s"))
+                    
+                    elif 'PHP Warning' in stream:
+                        stream = stream.split(sep=',')[0]
+                        submission_file.feedback.append(format_feedback(stream)) 
+                    
+                    elif 'ParseError: syntax error' in stream:
+                        submission_file.score = attempt_points
+                        submission_file.feedback.append(format_feedback("PHP Fatal error:  Uncaught ParseError: syntax error")) 
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
+                   
+                    elif 'Call to undefined function' in stream:
+                        stream = PHP_ERROR.search(stream).group().strip()
+                        submission_file.score = attempt_points
+                        submission_file.feedback.append(format_feedback(f'{stream}')) 
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
                         
-                            if'OK' in stream: # PASS
-                                stdout = "PHP Unit: Test Passed"
-                                submission_file.score = correct_points
-                                submission_file.feedback.append(format_feedback(stdout)) 
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {correct_points} marks for an attempt and for passing the unit test/s"))
-                            
-                            elif 'PHP Warning' in stream:
-                                stream = stream.split(sep=',')[0]
-                                submission_file.feedback.append(format_feedback(stream)) 
-                            
-                            elif 'ParseError: syntax error' in stream:
-                                submission_file.score = attempt_points
-                                submission_file.feedback.append(format_feedback("PHP Fatal error:  Uncaught ParseError: syntax error")) 
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
-                           
-                            elif 'Call to undefined function' in stream:
-                                stream = re.search(r'Error: (.+?)\n', stream).group().strip()
-                                submission_file.score = attempt_points
-                                submission_file.feedback.append(format_feedback(f'{stream}')) 
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
-                                
-                            elif 'because the name is already in use' in stream:
-                                stream = re.search(r'PHP Fatal error: (.+?) in (.+?) ', stream)
-                                submission_file.score = attempt_points
-                                submission_file.feedback.append(format_feedback(f'PHP Fatal error: {stream.group(1)}')) 
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
-                            
-                            elif 'OK' not in stream:# Fail
-                                try:
-                                    stream  = re.search(r'(There was \d (error|failure):)[\s\S]([\w\s]*.*){1,2}', stdout, re.MULTILINE).group().strip()
-                                    stream = re.sub(r'\d\)\s{1,}question_\d{1,}::test', '', stream)
-                                    submission_file.score = attempt_points
-                                    submission_file.feedback.append(format_feedback(stream.replace('\n', ' ')))  
-                                    submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
-                                except Exception as e:
-                                    submission_file.score = attempt_points
-                                    submission_file.feedback.append(format_feedback(stream.replace('\n', ' ')))  
-                                    submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
-                      
-                        if submission_file.spec.identifier.endswith('.js'): # Java Script   
-                                        
-                            if 'failing' in stream:
-                                stream = re.search(r'(^.*\wError:*.*)', stream, re.MULTILINE).group().strip()
-                                submission_file.score = attempt_points
-                                submission_file.feedback.append(format_feedback(stream))
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
-                            elif '✔' in stream:
-                                stream = "Mocha: Test Passed"
-                                submission_file.score = correct_points
-                                submission_file.feedback.append(format_feedback(stream))
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {correct_points} marks for an attempt and marks for passing the unit test/s"))
-                            
-                            elif 'Error' in stream:
-                                stream = re.search(r'.*Error+.*', stream.strip()).group().strip()
-                                submission_file.feedback.append(format_feedback(stream))
-                                submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
+                    elif 'because the name is already in use' in stream:
+                        stream = PHP_FATAL_ERROR.search(stream)
+                        submission_file.score = attempt_points
+                        submission_file.feedback.append(format_feedback(f'PHP Fatal error: {stream.group(1)}')) 
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
+                    
+                    elif 'OK' not in stream:# Fail
+                        try:
+                            stream  = PHPUNIT_FAILURE.search(stdout).group().strip()
+                            stream = PHPUNIT_TEST_NAME.sub('', stream)
+                            submission_file.score = attempt_points
+                            submission_file.feedback.append(format_feedback(stream.replace('\n', ' ')))  
+                            submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
+                        except Exception as e:
+                            submission_file.score = attempt_points
+                            submission_file.feedback.append(format_feedback(stream.replace('\n', ' ')))  
+                            submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt")) 
+              
+                if submission_file.spec.identifier.endswith('.js'): # Java Script   
                                 
-            
-            elif not simple:
-                
-                if process.returncode == 0:
-                    submission_file.score = correct_points
-                    if stdout:
-                        submission_file.feedback.append(format_feedback(stdout))
-                else:
-                    submission_file.score = attempt_points
-                    if stdout:
-                        submission_file.feedback.append(format_feedback(stdout))
-                    if stderr:
-                        submission_file.feedback.append(format_feedback(stderr))                
-        
+                    if 'failing' in stream:
+                        stream = JS_ERROR_LINE.search(stream).group().strip()
+                        submission_file.score = attempt_points
+                        submission_file.feedback.append(format_feedback(stream))
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
+                    elif '✔' in stream:
+                        stream = "Mocha: Test Passed"
+                        submission_file.score = correct_points
+                        submission_file.feedback.append(format_feedback(stream))
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {correct_points} marks for an attempt and marks for passing the unit test/s"))
+                    
+                    elif 'Error' in stream:
+                        stream = JS_ERROR.search(stream.strip()).group().strip()
+                        submission_file.feedback.append(format_feedback(stream))
+                        submission_file.feedback.append(format_feedback(f"You have been awarded {attempt_points} marks for an attempt"))
+                        
+    
+    elif not simple:
         
-        except TimeoutExpired:
-            process.kill()
-            stdout = None
-            stderr = 'Test failed due to timeout'
-            
-               
-def run_jest_test(command = "", parameters=[], timeout=30):
+        if returncode == 0:
+            submission_file.score = correct_points
+            if stdout:
+                submission_file.feedback.append(format_feedback(stdout))
+        else:
+            submission_file.score = attempt_points
+            if stdout:
+                submission_file.feedback.append(format_feedback(stdout))
+            if stderr:
+                submission_file.feedback.append(format_feedback(stderr))                
+
+
+def run_jest_test(command = "", parameters=[], timeout=30, limits=None, parser=None, report=None):
+
+    _remove_report(report)
+    returncode, stdout, stderr, usage = _run_process(command, parameters, timeout, limits)
+    return _jest_result(returncode, stdout, stderr, usage, parser, report)
+
+
+def _jest_result(returncode, stdout, stderr, usage, parser, report):
+    """Create the result of :func:`~automarking.tests.run_jest_test`. With a ``parser``, the
+    ``results`` are the parsed test cases, or ``None`` if the output could not be parsed."""
+    if returncode is None:
+        result = {'out': None, 'err': 'Test failed due to timeout', 'code': usage['returncode'], 'usage': usage}
+    else:
+        result = {'out': stdout.decode('utf-8'), 'err': stderr.decode('utf-8'), 'code': returncode, 'usage': usage}
+    if parser is not None:
+        result['results'] = parse_test_output(parser, stdout, stderr, report) if returncode is not None else None
+    return result
+
+
+class TestLimiter(object):
+    """Limits how many test processes :func:`~automarking.tests.run_test_async` and
+    :func:`~automarking.tests.run_jest_test_async` run at the same time. Each command (identified
+    by the name of its executable) gets its own limit, so that for example fewer PHPUnit than
+    mocha processes run concurrently.
+
+    Must be used from within a single event loop."""
+
+    def __init__(self, limits=None, default=4):
+        """:param limits: The maximum number of concurrent processes for each command name,
+                          e.g. ``{'phpunit': 2, 'mocha': 8}``
+        :type limits: ``dict``
+        :param default: The maximum number of concurrent processes for all other commands
+        :type default: ``int``
+        """
+        self.limits = limits if limits is not None else {}
+        self.default = default
+        self._semaphores = {}
+
+    def __call__(self, command):
+        key = os.path.basename(command)
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(self.limits.get(key, self.default))
+        return self._semaphores[key]
+
+
+class _NoLimit(object):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type_, value, traceback):
+        return False
+
+
+async def _communicate(command, parameters, timeout, limiter, limits=None):
+    """Run the test process and return (returncode, stdout, stderr, usage). The returncode, stdout and
+    stderr are ``None`` if the process timed out. The CPU time and peak memory are not available.
+    The output is read through pipes that are not part of the subprocess transport, so that
+    waiting for the process does not wait for the processes that it left running to close them."""
+    limits = limits if limits is not None else {}
+    max_output = limits.get('output', DEFAULT_OUTPUT_LIMIT)
+    orphans = set()
+    loop = asyncio.get_running_loop()
+    async with (limiter(command) if limiter is not None else _NoLimit()):
+        start = time.monotonic()
+        pipes = [os.pipe(), os.pipe()]
+
+        def stop():
+            orphans.update(_kill_process_group(process.pid, exclude=process.pid))
 
-    with Popen([command] + parameters, stdout=PIPE, stderr=PIPE) as process:
         try:
-            
-            stdout, stderr = process.communicate(timeout=timeout)
-            stdout = stdout.decode('utf-8')
-            stderr = stderr.decode('utf-8')
-            process.kill()
+            process = await asyncio.create_subprocess_exec(command, *parameters,
+                                                           stdout=pipes[0][1],
+                                                           stderr=pipes[1][1],
+                                                           preexec_fn=_resource_limiter(limits),
+                                                           start_new_session=True)
+            if process.returncode is None:
+                _apply_limits(process.pid, limits, stop)
+        except BaseException:
+            for read_fd, _ in pipes:
+                os.close(read_fd)
+            raise
+        finally:
+            for _, write_fd in pipes:
+                os.close(write_fd)
 
+        async def read(output, stream):
+            while True:
+                chunk = await stream.read(65536)
+                if not chunk:
+                    break
+                output.feed(chunk)
+
+        outputs = [_BoundedOutput(max_output, stop), _BoundedOutput(max_output, stop)]
+        transports = []
+        readers = []
+        try:
+            for output, (read_fd, _) in zip(outputs, pipes):
+                stream = asyncio.StreamReader()
+                transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stream),
+                                                            os.fdopen(read_fd, 'rb', 0))
+                transports.append(transport)
+                readers.append(asyncio.ensure_future(read(output, stream)))
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                stop()
+                await process.wait()
+                orphans = len(orphans | _kill_process_group(process.pid))
+                return (None, None, None, _usage(command, start, process.returncode, None, limits, timed_out=True,
+                                                 orphans=orphans))
+            # Processes that the test left running would otherwise hold the pipes open
+            stop()
+            # A process that left the process group may still hold the pipes open, and the output read
+            # until then is the test's output
+            await asyncio.wait(readers, timeout=1)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for transport in transports:
+                transport.close()
+    orphans = len(orphans | _kill_process_group(process.pid))
+    stdout, stderr = [output.getvalue() for output in outputs]
+    truncated = any(output.truncated for output in outputs)
+    return (process.returncode, stdout, stderr,
+            _usage(command, start, process.returncode, None, limits, truncated=truncated, stderr=stderr,
+                   orphans=orphans))
+
+
+async def run_test_async(command, parameters, submission_file, timeout=60, correct_points=4, attempt_points=2, simple=False, limiter=None, cache=None, harness=None, limits=None,
+                         parser=None, report=None, partial_credit=False):
+    """Asynchronous version of :func:`~automarking.tests.run_test`, which lets the tests of many
+    submissions run at the same time. The number of concurrent processes is limited by the
+    ``limiter``.
+
+    :param limiter: The limits to apply to the test process
+    :type limiter: :class:`~automarking.tests.TestLimiter`
+    :param cache: The cache of previous test results
+    :type cache: :class:`~automarking.cache.TestResultCache`
+    :param harness: Run the test on this pool of warm harness processes
+    :type harness: :class:`~automarking.tests.HarnessPool`
+    :param limits: Resource limits for the test process, as for :func:`~automarking.tests.run_test`
+    :type limits: ``dict``
+    :param parser: The parser for the test's output, as for :func:`~automarking.tests.run_test`.
+                   Tests that run at the same time must use different ``report`` files.
+    :param report: The filename of the report that the test writes
+    :type report: ``unicode``
+    :param partial_credit: Award a share of the marks for each test case that passed
+    :type partial_credit: ``boolean``
+    """
+    if harness is None:
+        harness = getattr(submission_file.spec, 'harness', None)
+    if cache is not None:
+        key = cache.key(submission_file, command, parameters, timeout, correct_points, attempt_points, simple, limits,
+                        getattr(parser, '__name__', parser), partial_credit)
+        if cache.apply(key, submission_file):
+            return
+        score, feedback_length = submission_file.score, len(submission_file.feedback)
+    _remove_report(report)
+    if harness is not None:
+        start = time.monotonic()
+        result = await asyncio.get_running_loop().run_in_executor(None, partial(harness.run, parameters, timeout,
+                                                                                limits=limits))
+        usage = _harness_usage(start, result, limits)
+    else:
+        result = await _communicate(command, parameters, timeout, limiter, limits)
+        usage = result[3]
+        if result[0] is None:
+            result = None
+    _record_usage(submission_file, usage)
+    if result is not None:
+        _score_test(submission_file, result[0], result[1], result[2], usage, limits, correct_points,
+                    attempt_points, simple, parser, report, partial_credit)
+        if cache is not None:
+            cache.record(key, submission_file, score, feedback_length)
+
+
+async def run_jest_test_async(command="", parameters=[], timeout=30, limiter=None, limits=None, parser=None, report=None):
+    """Asynchronous version of :func:`~automarking.tests.run_jest_test`.
+
+    :param limiter: The limits to apply to the test process
+    :type limiter: :class:`~automarking.tests.TestLimiter`
+    """
+    _remove_report(report)
+    returncode, stdout, stderr, usage = await _communicate(command, parameters, timeout, limiter, limits)
+    return _jest_result(returncode, stdout, stderr, usage, parser, report)
+
+
+def resource_summary(submissions):
+    """Summarise the resources used by the tests of all :class:`~automarking.core.SubmissionPart`\ s
+    in the ``submissions`` per :class:`~automarking.core.SubmissionSpec`.
+
+    :return: For each spec identifier a ``dict`` with the number of ``tests``, the total
+             ``wall_time`` and ``cpu_time``, the largest ``peak_rss``, the number of tests for
+             each ``exit_reason`` and the number of left-over ``orphans`` processes that were killed
+    :rtype: ``dict``
+    """
+    summary = {}
+    for submission in submissions:
+        for part in submission.parts:
+            for usage in part.resources:
+                spec = summary.setdefault(part.spec.identifier, {'tests': 0, 'wall_time': 0, 'cpu_time': 0,
+                                                                 'peak_rss': 0, 'exit_reasons': {}, 'orphans': 0})
+                spec['tests'] = spec['tests'] + 1
+                spec['wall_time'] = spec['wall_time'] + usage['wall_time']
+                spec['cpu_time'] = spec['cpu_time'] + (usage['cpu_time'] or 0)
+                spec['peak_rss'] = max(spec['peak_rss'], usage['peak_rss'] or 0)
+                spec['exit_reasons'][usage['exit_reason']] = spec['exit_reasons'].get(usage['exit_reason'], 0) + 1
+                spec['orphans'] = spec['orphans'] + usage.get('orphans', 0)
+    return summary
+
+
+HARNESS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'harness')
+MOCHA_HARNESS = ['node', os.path.join(HARNESS_DIR, 'mocha_worker.js')]
+PHPUNIT_HARNESS = ['php', os.path.join(HARNESS_DIR, 'phpunit_worker.php')]
+
+
+class HarnessPool(object):
+    """A pool of long-lived test harness processes that run tests without starting a new
+    interpreter for every test. :data:`MOCHA_HARNESS` runs mocha tests in a warm ``node`` process and
+    :data:`PHPUNIT_HARNESS` forks a warm ``php`` process that has PHPUnit loaded for each test.
+
+    Each job is sent to a worker as a JSON line on its stdin and the worker writes a JSON line
+    with the ``returncode``, ``stdout`` and ``stderr`` of the test to the file descriptor given in
+    the ``AUTOMARKING_HARNESS_FD`` environment variable. Workers are replaced after ``max_jobs``
+    jobs, when a test times out, and when they crash. Each worker runs in its own process group,
+    and any processes left over when it is replaced are killed and counted in ``orphans``.
+
+    To use the pool for a :class:`~automarking.core.SubmissionSpec`, set the spec's ``harness``
+    attribute or pass it to :func:`~automarking.tests.run_test` with the ``harness`` parameter. The
+    test ``parameters`` are then sent to the harness and the ``command`` is not used.
+    """
+
+    def __init__(self, command, size=2, max_jobs=100):
+        """:param command: The command that starts a harness process, e.g. :data:`MOCHA_HARNESS`
+        :type command: ``list``
+        :param size: The number of harness processes
+        :type size: ``int``
+        :param max_jobs: The number of jobs after which a harness process is replaced
+        :type max_jobs: ``int``
+        """
+        self.command = command
+        self.size = size
+        self.max_jobs = max_jobs
+        self._setup()
+
+    def _setup(self):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.orphans = 0
+
+    def __getstate__(self):
+        # Each process that uses the pool starts its own harness processes
+        return {'command': self.command, 'size': self.size, 'max_jobs': self.max_jobs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def run(self, parameters, timeout=60, cwd=None, limits=None):
+        """Run the test with the ``parameters`` on one of the harness processes.
+
+        :param limits: The ``output``, ``memory`` and ``cpu`` limits, as for
+                       :func:`~automarking.tests.run_test`. The harness enforces them itself, and
+                       raises a ``ValueError`` for a limit that it cannot enforce.
+        :type limits: ``dict``
+        :return: (returncode, stdout, stderr, exit_reason), with stdout and stderr as ``bytes`` and
+                 the exit_reason set if the test was stopped by one of the ``limits``, or ``None``
+                 if the test timed out
+        :rtype: ``tuple``
+        """
+        limits = dict(limits or {})
+        limits['output'] = limits.get('output', DEFAULT_OUTPUT_LIMIT)
+        with self._slots:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                worker = _HarnessWorker(self.command)
+            try:
+                result = worker.run({'id': next(self._ids), 'args': list(parameters), 'cwd': cwd, 'limits': limits},
+                                    timeout)
+            except _HarnessCrash as crash:
+                self._close(worker)
+                return (-1, b'', ('The test harness stopped unexpectedly\n%s' % crash).encode('utf-8'), None)
+            if result is None or worker.jobs >= self.max_jobs:
+                self._close(worker)
+            else:
+                self._idle.put(worker)
+        if result is None:
+            return None
+        if 'error' in result:
+            raise ValueError(result['error'])
+        return (result['returncode'], _harness_output(result['stdout'], limits['output']),
+                _harness_output(result['stderr'], limits['output']), result.get('exit_reason'))
+
+    def close(self):
+        """Stop all idle harness processes."""
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _close(self, worker):
+        orphans = worker.close()
+        with self._lock:
+            self.orphans = self.orphans + orphans
+
+
+def _harness_output(output, limit):
+    """Rebuild the start and end of an output stream, as kept by a harness process."""
+    bounded = _BoundedOutput(limit)
+    bounded.head = bytearray(base64.b64decode(output['head']))
+    bounded.tail = bytearray(base64.b64decode(output['tail']))
+    bounded.size = output['size']
+    return bounded.getvalue()
+
+
+class _HarnessCrash(Exception):
+    pass
+
+
+class _HarnessWorker(object):
+    """A single harness process used by the :class:`~automarking.tests.HarnessPool`."""
+
+    def __init__(self, command):
+        read_fd, write_fd = os.pipe()
+        self._stderr = tempfile.TemporaryFile()
+        try:
+            self.process = Popen(command, stdin=PIPE, stdout=DEVNULL, stderr=self._stderr,
+                                 pass_fds=(write_fd,), start_new_session=True,
+                                 env=dict(os.environ, AUTOMARKING_HARNESS_FD=str(write_fd)))
+        finally:
+            os.close(write_fd)
+        self._fd = read_fd
+        self._buffer = b''
+        self.jobs = 0
+
+    def run(self, job, timeout):
+        """Send the ``job`` and wait for its result. Returns ``None`` on timeout."""
+        self.jobs = self.jobs + 1
+        try:
+            self.process.stdin.write((json.dumps(job) + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise _HarnessCrash(self._error_output())
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if ready:
+                chunk = os.read(self._fd, 65536)
+                if not chunk:
+                    raise _HarnessCrash(self._error_output())
+                self._buffer = self._buffer + chunk
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def _error_output(self):
+        self._stderr.seek(0)
+        return self._stderr.read()[-4096:].decode('utf-8', errors='replace')
+
+    def close(self):
+        """Stop the harness process and any processes that the tests started.
+
+        :return: The number of left-over processes that were killed
+        :rtype: ``int``
+        """
+        orphans = _kill_process_group(self.process.pid, exclude=self.process.pid)
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdin.close()
+        self.process.wait()
+        orphans = len(orphans | _kill_process_group(self.process.pid))
+        os.close(self._fd)
+        self._stderr.close()
+        return orphans
 
-        except TimeoutExpired:
-            process.kill()
-            stdout = None
-            stderr = 'Test failed due to timeout'
-            
-        return {'out': stdout, 'err': stderr, 'code': process.returncode}
 
 def process_message(json):
     message = ""
@@ -206,31 +1051,54 @@ text: Human-readable text (not for machine parsing)
 '''
 
 
-def run_html_validator(path_to_submission_file, output_format='json', timeout=60, cmd='curl'):
+def _validator_result(returncode, stdout, output_format):
+    """Return the validation result from the output of ``curl --fail``, parsed if it is JSON, or
+    ``VALIDATOR_UNAVAILABLE`` if the request failed or the result is invalid."""
+    if returncode != 0:
+        return VALIDATOR_UNAVAILABLE
+    try:
+        stdout = stdout.decode('utf-8')
+        if stdout != "" and output_format == 'json':
+            return json.loads(stdout)
+    except ValueError:
+        return VALIDATOR_UNAVAILABLE
+    return stdout
+
+
+def run_html_validator(path_to_submission_file, output_format='json', timeout=60, cmd='curl', cache=None, client=None):
     feedback = ""
 
+    if cache is not None:
+        with open(path_to_submission_file, 'rb') as in_f:
+            key = cache.key(in_f.read(), output_format, HTML_VALIDATOR_URL)
+        feedback = cache.get(key)
+        if feedback is not None:
+            return feedback
+        feedback = ""
+
+    if client is not None:
+        feedback = client.validate_html(path_to_submission_file, output_format)
+        if cache is not None and feedback not in ("", VALIDATION_TIMEOUT, VALIDATOR_UNAVAILABLE):
+            cache.put(key, HTML_VALIDATOR_URL, feedback)
+        return feedback
+
     data = open(path_to_submission_file, encoding="utf-8").read()
 
-    command = [cmd, '-X', 'POST', HTML_VALIDATOR_URL + "out={}".format(output_format), '--data-binary',
+    command = [cmd, '--fail', '-X', 'POST', HTML_VALIDATOR_URL + "out={}".format(output_format), '--data-binary',
                "{}".format(data), '-H', "Content-Type: text/html;charset=utf-8"]
 
-    with Popen(command, stdout=PIPE,
-               stderr=PIPE) as process:
+    with instrumentation.phase('validate', validator='html'), Popen(command, stdout=PIPE, stderr=PIPE) as process:
 
         try:
             stdout, stderr = process.communicate(timeout=timeout)
-            stdout = stdout.decode('utf-8')
-            stderr = stderr.decode('utf-8')
-
-            if stdout != "":
-                if output_format == 'json':
-                    stdout_dic = json.loads(stdout)
+            feedback = _validator_result(process.returncode, stdout, output_format)
 
-                feedback = stdout_dic
+            if cache is not None and feedback not in ("", VALIDATOR_UNAVAILABLE):
+                cache.put(key, HTML_VALIDATOR_URL, feedback)
 
         except TimeoutExpired:
             process.kill()
-            feedback = 'Validation failed due to timeout'
+            feedback = VALIDATION_TIMEOUT
 
     return feedback
 
@@ -246,25 +1114,216 @@ Triggers the various `outputs_formats` of the validator. The Possible formats ar
 '''
 
 
-def run_css_validator(path_to_submission_file, output_format='json', timeout=60, command='curl'):
+def run_css_validator(path_to_submission_file, output_format='json', timeout=60, command='curl', cache=None, client=None):
     feedback = ""
 
+    if cache is not None:
+        with open(path_to_submission_file, 'rb') as in_f:
+            key = cache.key(in_f.read(), output_format, CSS_VALIDATOR_URL)
+        feedback = cache.get(key)
+        if feedback is not None:
+            return feedback
+        feedback = ""
+
+    if client is not None:
+        feedback = client.validate_css(path_to_submission_file, output_format)
+        if cache is not None and feedback not in ("", VALIDATION_TIMEOUT, VALIDATOR_UNAVAILABLE):
+            cache.put(key, CSS_VALIDATOR_URL, feedback)
+        return feedback
+
     safeCSS = urllib.parse.quote(open(path_to_submission_file).read(), safe='/')
 
-    with Popen([command] + [CSS_VALIDATOR_URL + "output={}&text={}&lang=en".format(output_format, safeCSS)],
-               stdout=PIPE,
-               stderr=PIPE) as process:
+    with instrumentation.phase('validate', validator='css'), \
+            Popen([command, '--fail'] + [CSS_VALIDATOR_URL + "output={}&text={}&lang=en".format(output_format, safeCSS)],
+                  stdout=PIPE,
+                  stderr=PIPE) as process:
 
         try:
             stdout, stderr = process.communicate(timeout=timeout)
-            stdout = stdout.decode('utf-8')
-            stderr = stderr.decode('utf-8')
+            feedback = _validator_result(process.returncode, stdout, output_format)
+            if not isinstance(feedback, str):
+                feedback = stdout.decode('utf-8')
 
-            if stdout != "":
-                feedback = stdout
+            if cache is not None and feedback not in ("", VALIDATOR_UNAVAILABLE):
+                cache.put(key, CSS_VALIDATOR_URL, feedback)
 
         except TimeoutExpired:
             process.kill()
-            feedback = 'Validation failed due to timeout'
+            feedback = VALIDATION_TIMEOUT
 
     return feedback
+
+
+class _ValidatorError(Exception):
+    """The validator did not return a validation result."""
+
+
+def _check_status(status):
+    """Raise a :class:`~automarking.tests._ValidatorError` unless the validator's response
+    ``status`` is a validation result."""
+    if status != 200:
+        raise _ValidatorError('The validator returned HTTP status %i' % status)
+
+
+class ValidatorClient(object):
+    """HTTP client for the HTML and CSS validators that keeps persistent connections to the
+    validator open, instead of starting a ``curl`` process for every file. The files are streamed
+    to the validator, so their size is not limited by the command-line length. The client can be
+    used from several threads at the same time and :meth:`~automarking.tests.ValidatorClient.validate_html_batch`
+    and :meth:`~automarking.tests.ValidatorClient.validate_css_batch` validate lists of files
+    concurrently.
+
+    Pass it to :func:`~automarking.tests.run_html_validator` or
+    :func:`~automarking.tests.run_css_validator` using the ``client`` parameter, or use it directly.
+    """
+
+    def __init__(self, html_url=HTML_VALIDATOR_URL, css_url=CSS_VALIDATOR_URL, timeout=60, max_connections=4, cache=None):
+        """:param html_url: The URL of the HTML validator
+        :type html_url: ``unicode``
+        :param css_url: The URL of the CSS validator
+        :type css_url: ``unicode``
+        :param timeout: The timeout in seconds for each validation
+        :type timeout: ``int``
+        :param max_connections: The number of connections to keep open to each validator, which is
+                                also the number of files the batch methods validate concurrently
+        :type max_connections: ``int``
+        :param cache: The cache of previous validation results
+        :type cache: :class:`~automarking.cache.ValidatorCache`
+        """
+        self.html_url = html_url
+        self.css_url = css_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.cache = cache
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, scheme, netloc):
+        with self._lock:
+            if (scheme, netloc) not in self._pools:
+                self._pools[(scheme, netloc)] = queue.LifoQueue()
+            return self._pools[(scheme, netloc)]
+
+    def _request(self, method, url, body, headers):
+        """Send the request on a pooled connection and return (status, response body). Requests on
+        a connection that the validator has closed in the meantime are retried once."""
+        url = urllib.parse.urlsplit(url)
+        path = url.path + ('?' + url.query if url.query else '')
+        pool = self._pool(url.scheme, url.netloc)
+        for attempt in range(2):
+            try:
+                connection = pool.get_nowait()
+                fresh = False
+            except queue.Empty:
+                if url.scheme == 'https':
+                    connection = http.client.HTTPSConnection(url.netloc, timeout=self.timeout)
+                else:
+                    connection = http.client.HTTPConnection(url.netloc, timeout=self.timeout)
+                fresh = True
+            if callable(body):
+                request_body = body()
+            else:
+                request_body = body
+            try:
+                connection.request(method, path, body=request_body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if fresh or attempt > 0:
+                    raise
+                continue
+            except BaseException:
+                connection.close()
+                raise
+            finally:
+                if hasattr(request_body, 'close'):
+                    request_body.close()
+            if response.will_close:
+                connection.close()
+            elif pool.qsize() < self.max_connections:
+                pool.put(connection)
+            else:
+                connection.close()
+            return (response.status, data)
+
+    def _validate(self, url, path, output_format, send):
+        if self.cache is not None:
+            with open(path, 'rb') as in_f:
+                key = self.cache.key(in_f.read(), output_format, url)
+            feedback = self.cache.get(key)
+            if feedback is not None:
+                return feedback
+        try:
+            with instrumentation.phase('validate', validator='html' if url == self.html_url else 'css'):
+                feedback = send(path, output_format)
+        except socket.timeout:
+            return VALIDATION_TIMEOUT
+        except (_ValidatorError, http.client.HTTPException, OSError):
+            return VALIDATOR_UNAVAILABLE
+        if self.cache is not None and feedback != "":
+            self.cache.put(key, url, feedback)
+        return feedback
+
+    def _send_html(self, path, output_format):
+        def body():
+            return open(path, 'rb')
+        size = os.path.getsize(path)
+        status, data = self._request('POST', self.html_url + 'out={}'.format(output_format), body,
+                                     {'Content-Type': 'text/html;charset=utf-8',
+                                      'Content-Length': str(size)})
+        _check_status(status)
+        data = data.decode('utf-8')
+        if data != "" and output_format == 'json':
+            try:
+                return json.loads(data)
+            except ValueError:
+                raise _ValidatorError('The validator returned invalid JSON')
+        return data
+
+    def _send_css(self, path, output_format):
+        boundary = uuid.uuid4().hex
+        preamble = ''.join('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value)
+                           for name, value in (('output', output_format), ('lang', 'en')))
+        preamble = (preamble + '--{}\r\nContent-Disposition: form-data; name="text"\r\n\r\n'.format(boundary)).encode('utf-8')
+        epilogue = '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+        def body():
+            yield preamble
+            with open(path, 'rb') as in_f:
+                for chunk in iter(lambda: in_f.read(65536), b''):
+                    yield chunk
+            yield epilogue
+        size = len(preamble) + os.path.getsize(path) + len(epilogue)
+        status, data = self._request('POST', self.css_url.rstrip('?'), body,
+                                     {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary),
+                                      'Content-Length': str(size)})
+        _check_status(status)
+        return data.decode('utf-8')
+
+    def validate_html(self, path, output_format='json'):
+        """Validate the HTML file at ``path``. Returns the same result as
+        :func:`~automarking.tests.run_html_validator`."""
+        return self._validate(self.html_url, path, output_format, self._send_html)
+
+    def validate_css(self, path, output_format='json'):
+        """Validate the CSS file at ``path``. Returns the same result as
+        :func:`~automarking.tests.run_css_validator`."""
+        return self._validate(self.css_url, path, output_format, self._send_css)
+
+    def validate_html_batch(self, paths, output_format='json'):
+        """Validate all HTML files in ``paths`` concurrently and return the results in the same order."""
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            return list(executor.map(lambda path: self.validate_html(path, output_format), paths))
+
+    def validate_css_batch(self, paths, output_format='json'):
+        """Validate all CSS files in ``paths`` concurrently and return the results in the same order."""
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            return list(executor.map(lambda path: self.validate_css(path, output_format), paths))
+
+    def close(self):
+        """Close all open connections."""
+        with self._lock:
+            for pool in self._pools.values():
+                while not pool.empty():
+                    pool.get_nowait().close()
@@ -10,11 +10,171 @@
 import os
 import glob
 import shutil
-from zipfile import ZipFile
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from zipfile import ZipFile, ZipInfo, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+
+from .core import GradebookIndex
+
+
+_WORKER_SCRATCH = {}
 
 def format_feedback(feedback, start_tag='\t<li>', end_tag='\t</li>',):
     return f"{start_tag}{feedback}{end_tag}"
 
+def copy_zip_member(source, info, target, arcname=None):
+    """Copy the member ``info`` of the zip file ``source`` into the zip file ``target``, which must
+    be open for writing, using the same compression method. Stored members are copied as they are.
+
+    :param source: The open source zip file
+    :type source: :class:`~zipfile.ZipFile`
+    :param info: The member to copy
+    :type info: :class:`~zipfile.ZipInfo`
+    :param target: The zip file to copy the member into
+    :type target: :class:`~zipfile.ZipFile`
+    :param arcname: The name of the member in the ``target``. Defaults to its current name.
+    :type arcname: ``unicode``
+    """
+    copy = ZipInfo(arcname if arcname is not None else info.filename, info.date_time)
+    copy.compress_type = info.compress_type
+    copy.create_system = info.create_system
+    copy.external_attr = info.external_attr
+    copy.file_size = info.file_size
+    with source.open(info) as in_f, target.open(copy, 'w') as out_f:
+        shutil.copyfileobj(in_f, out_f, 1024 * 1024)
+
+
+class ArchiveStatus(object):
+    """The outcome of processing one nested archive of the gradebook."""
+
+    FIXED = 'fixed'
+    UNCHANGED = 'unchanged'
+    UNREADABLE = 'unreadable'
+    OLD_ATTEMPT = 'old-attempt'
+
+    def __init__(self, name, status, message='', path=None):
+        """:param name: The name of the nested archive in the fixed gradebook
+        :type name: ``unicode``
+        :param status: One of ``fixed``, ``unchanged``, ``unreadable`` or ``old-attempt``
+        :type status: ``unicode``
+        :param message: Details, such as the error for an unreadable archive
+        :type message: ``unicode``
+        :param path: The scratch file holding the fixed archive, if it was written by a worker
+        :type path: ``unicode``
+        """
+        self.name = name
+        self.status = status
+        self.message = message
+        self.path = path
+
+    def __repr__(self):
+        return 'ArchiveStatus(%r, %r)' % (self.name, self.status)
+
+
+def _needs_fix(names, task_id):
+    count = sum(map(lambda x: task_id not in x, names))
+    nested = sum(map(lambda x: task_id in x, names))
+    return count > 1 or nested > 1
+
+
+def _flattened_members(archive, extensions):
+    """Select the members of the nested ``archive`` that the fixed archive contains, in the same
+    way as :func:`_flatten_directory`: files at the top level are kept, files in sub-directories
+    are moved to the top level if they have one of the task's file ``extensions`` and their name is
+    not taken yet, and everything else is dropped. The fixed archive has them in its ``temp/``
+    directory, sorted by name, as :func:`_fix_extracted_zip` writes them."""
+    selected = {}
+    infos = [info for info in archive.infolist() if not info.is_dir() and '__MACOSX' not in info.filename]
+    for info in sorted(infos, key=lambda info: info.filename.count('/')):
+        name = info.filename.rsplit('/', 1)[-1]
+        if name in selected:
+            continue
+        if '/' not in info.filename or any(ex in name for ex in extensions):
+            selected[name] = info
+    return selected
+
+
+def _flatten_directory(directory, extensions):
+    """Move the files with one of the task's file ``extensions`` from the sub-directories of the
+    extracted archive in ``directory`` to its top level and remove the sub-directories."""
+    for path, subdirs, files in os.walk(directory):
+        if '__MACOSX' not in path:
+            for name in sorted(files):
+                if any(ex in name for ex in extensions):
+                    try:
+                        shutil.move(os.path.join(path, name), directory)
+                    except shutil.Error:
+                        # file already exists
+                        pass
+        elif os.path.exists(path):
+            shutil.rmtree(path)
+    # Removes subdirectories
+    for element in os.scandir(directory):
+        if element.is_dir():
+            shutil.rmtree(element)
+
+
+def _worker_scratch(root):
+    """Return the scratch directory of the current worker process, which is created under ``root``
+    the first time it is needed, so that workers never share extracted files."""
+    key = (os.getpid(), root)
+    if key not in _WORKER_SCRATCH:
+        _WORKER_SCRATCH[key] = tempfile.mkdtemp(prefix='worker_', dir=root)
+    return _WORKER_SCRATCH[key]
+
+
+def _fix_nested_zip(data, name, index, task_id, extensions, scratch_root):
+    """Fix the nested zip archive ``data`` in a worker process. If it needs fixing, then the flattened
+    archive is written to the worker's scratch directory and its path is returned in the
+    :class:`~automarking.utils.ArchiveStatus`. The files keep their compression method."""
+    path = os.path.join(_worker_scratch(scratch_root), '%i.zip' % index)
+    try:
+        with ZipFile(BytesIO(data)) as archive:
+            if not _needs_fix(archive.namelist(), task_id):
+                return ArchiveStatus(name, ArchiveStatus.UNCHANGED)
+            members = _flattened_members(archive, extensions)
+            with ZipFile(path, 'w') as fixed_zip:
+                fixed_zip.writestr('temp/', b'')
+                for member_name, member in sorted(members.items()):
+                    copy_zip_member(archive, member, fixed_zip, 'temp/' + member_name)
+    except Exception as exception:
+        if os.path.exists(path):
+            os.remove(path)
+        return ArchiveStatus(name, ArchiveStatus.UNREADABLE, str(exception))
+    return ArchiveStatus(name, ArchiveStatus.FIXED, '%i files' % len(members), path)
+
+
+def _fix_extracted_zip(path, task_id, extensions, scratch_root, out_dir):
+    """Fix the extracted nested zip archive at ``path`` in a worker process, writing the result to
+    ``out_dir``. The archive is extracted into the worker's own scratch directory."""
+    name = os.path.basename(path)
+    scratch = _worker_scratch(scratch_root)
+    temp = os.path.join(scratch, 'temp')
+    try:
+        with ZipFile(path) as archive:
+            fix = _needs_fix(archive.namelist(), task_id)
+            if fix:
+                archive.extractall(path=temp)
+        if not fix:
+            os.rename(src=path, dst=os.path.join(out_dir, name))
+            return ArchiveStatus(name, ArchiveStatus.UNCHANGED)
+        _flatten_directory(temp, extensions)
+        # The files are written sorted by name, as :func:`_fix_nested_zip` writes them
+        with ZipFile(os.path.join(out_dir, os.path.splitext(name)[0] + '.zip'), 'w', ZIP_DEFLATED) as fixed_zip:
+            fixed_zip.write(temp, 'temp')
+            for file_name in sorted(os.listdir(temp)):
+                fixed_zip.write(os.path.join(temp, file_name), 'temp/' + file_name)
+        return ArchiveStatus(name, ArchiveStatus.FIXED)
+    except Exception as exception:
+        os.rename(src=path, dst=os.path.join(out_dir, name))
+        return ArchiveStatus(name, ArchiveStatus.UNREADABLE, str(exception))
+    finally:
+        if os.path.exists(temp):
+            shutil.rmtree(temp)
+
+
 class GradeBookFix():
 
     def __init__(self, task_id, module_code, task_file_extensions, gradebook_path, cwd):
@@ -27,6 +187,7 @@ class GradeBookFix():
         self.GB_DIR_ORIGINAL = '{}gradebook_old'.format(self.current_working_directory)
         self.TEMP_DIR = '{}temp/'.format(self.current_working_directory)
         self.DIR_LIST = [self.TEMP_DIR, self.GB_DIR_ORIGINAL, self.OUT_DIR]
+        self.statuses = []
 
     def __cleanup(self):
         for dir in self.DIR_LIST:
@@ -34,8 +195,9 @@ class GradeBookFix():
                 shutil.rmtree(dir)
 
     def __create_temp_directories(self):
-        if not os.path.exists(self.OUT_DIR):
-            os.mkdir(self.OUT_DIR)
+        for dir in (self.OUT_DIR, self.TEMP_DIR):
+            if not os.path.exists(dir):
+                os.mkdir(dir)
 
     def __extract_gradebook(self):
         zip = ZipFile(self.gradebook_path)
@@ -43,113 +205,158 @@ class GradeBookFix():
             if '__MACOSX' not in archive and zip.filename.endswith('.zip'):
                 zip.extract(archive, path=self.GB_DIR_ORIGINAL)
 
-    def __create_fixed_zip(self, original_filename):
-        print('processing ' + original_filename)
-        for path, subdirs, files in os.walk(self.TEMP_DIR):
-            if '__MACOSX' not in path:
-                for name in files:
-                    if any(ex in name for ex in self.task_file_extensions):
-
-                        print(str(path))
-                        try:
-                            shutil.move(os.path.join(path, name), self.TEMP_DIR)
-                        except:
-                            # file already exists
-                            pass
-            else:
-                if os.path.exists(path):
-                    shutil.rmtree(path)
-        # Removes subdirectories
-        for element in os.scandir(self.TEMP_DIR):
-            if element.is_dir():
-                shutil.rmtree(element)
-
-        archive_name = os.path.basename(original_filename)
-        destination = self.OUT_DIR + archive_name.strip('.zip')
-        source = self.TEMP_DIR
-        shutil.make_archive(base_name=destination, format='zip',
-                            base_dir=source, root_dir=self.current_working_directory)
-
-        if os.path.exists(self.TEMP_DIR):
-            shutil.rmtree(self.TEMP_DIR)
-
-    def __process_submission(self):
+    def __process_submission(self, processes):
         DL_ZIP_FILES = []
+        names = set()
+        for path in sorted(glob.glob(self.GB_DIR_ORIGINAL + '/**/*zip', recursive=True)):
+            if os.path.basename(path) not in names:
+                names.add(os.path.basename(path))
+                DL_ZIP_FILES.append(path)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_fix_extracted_zip, archive, self.task_id, self.task_file_extensions,
+                                       self.TEMP_DIR, self.OUT_DIR) for archive in DL_ZIP_FILES]
+            self.statuses.extend(future.result() for future in futures)
 
-        for path in glob.glob(self.GB_DIR_ORIGINAL + '/**/*zip', recursive=True):
-            DL_ZIP_FILES.append(path)
-
-        for archive in DL_ZIP_FILES:
-            name = "/" + archive.split('/')[-1]
-            archive_name = archive
-            try:
-                archive = ZipFile(archive)
-
-                count = sum(map(lambda x: self.task_id not in x, archive.namelist()))
-                nested = sum(map(lambda x: self.task_id in x, archive.namelist()))
-                # Fixes ZIP
-                if count > 1 or nested > 1:
-                    a = archive.namelist()
-                    archive.extractall(path=self.TEMP_DIR)
-                    self.__create_fixed_zip(archive.filename)
-                # Moves Zip
-                else:
-                    os.rename(src=archive_name, dst=self.OUT_DIR + name)
-            except:
-                print('The following file cannot be unzipped: {}'.format(name))
-                os.rename(src=archive_name, dst=self.OUT_DIR + name)
     def __compress_modified_gradebook(self):
-        print('[Ultra Gradebook] Compressing modified Gradebook')
         archive_name = os.path.expanduser(os.path.join(self.current_working_directory,
-                                                       'gradebook_{}_{}_fixed'.format(self.module_code, self.task_id)))
-        root_dir = os.path.expanduser(os.path.join(self.current_working_directory, self.OUT_DIR))
-        shutil.make_archive(archive_name, 'zip', root_dir)
-
-    def __remove_old_attempts(self):
-        print('[Ultra Gradebook] Removing old attempts...')
-        last_sub_dic = {}
-        dup_subs = {}
-        for path, subdirs, files in os.walk(self.GB_DIR_ORIGINAL):
-            for name in files:
-                if name.endswith('.zip'):
-                    parts = name.split("_")
-                    student = parts[1]
-                    last_sub_dic[student] = name
-        for name in last_sub_dic.values():
-            os.rename(src="{}/{}".format(self.GB_DIR_ORIGINAL, name), dst=self.OUT_DIR + name)
-
-        # Proof
-        # if student in dup_subs.keys():
-        #     dup_subs[student] = dup_subs.get(student) + 1
-        # else:
-        #     dup_subs[student] = 1
-
-        # print(parts)
-
-        # dup = {k:v for (k,v) in dup_subs.items() if v > 1}
-        # for student in dup.keys():
-        #     print(last_sub_dic.get(student))
-
-    def fix_zips(self):
-        print('[Fixing Zips] Starting....')
-        self.__cleanup()
-        self.__create_temp_directories()
-        self.__extract_gradebook()
-        self.__process_submission()
-        self.__compress_modified_gradebook()
-        self.__cleanup()
-        print('[Fixing Zips] Completed....')
+                                                       'gradebook_{}_{}_fixed.zip'.format(self.module_code,
+                                                                                          self.task_id)))
+        # The archives are added in the order of the statuses, so that the result does not depend
+        # on the order in which the workers finished or the directory lists the files
+        with ZipFile(archive_name, 'w', ZIP_DEFLATED) as out_f:
+            for status in self.statuses:
+                out_f.write(os.path.join(self.OUT_DIR, status.name), status.name)
 
-    def ultra_gradebook_submission_download_fix(self):
-        print(
-        '[Ultra Gradebook] Beginning to fix Gradebook Submissions...')
+    def __nested_zips(self, gradebook):
+        """Yield the nested zip archives in the ``gradebook`` and their names in the fixed gradebook."""
+        written = set()
+        for info in gradebook.infolist():
+            if info.is_dir() or '__MACOSX' in info.filename or not info.filename.endswith('zip') \
+                    or not gradebook.filename.endswith('.zip'):
+                continue
+            name = os.path.basename(info.filename)
+            if name not in written:
+                written.add(name)
+                yield (info, name)
+
+    def __write_fixed_zip(self, gradebook, out_f, info, future):
+        """Write the result of a worker to the fixed gradebook ``out_f``. Nested archives that need
+        no fixing or cannot be read are copied with their compression method."""
+        status = future.result()
+        if status.path is None:
+            copy_zip_member(gradebook, info, out_f, status.name)
+        else:
+            fixed_info = ZipInfo(status.name, info.date_time)
+            fixed_info.compress_type = ZIP_STORED
+            fixed_info.file_size = os.path.getsize(status.path)
+            with open(status.path, 'rb') as fixed, out_f.open(fixed_info, 'w') as target:
+                shutil.copyfileobj(fixed, target)
+            os.remove(status.path)
+            status.path = None
+        self.statuses.append(status)
+
+    def __fix_zips_streaming(self, processes):
+        output = os.path.expanduser(os.path.join(self.current_working_directory,
+                                                 'gradebook_{}_{}_fixed.zip'.format(self.module_code, self.task_id)))
+        with ZipFile(self.gradebook_path) as gradebook, ZipFile(output + '.part', 'w') as out_f, \
+                ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = deque()
+            for index, (info, name) in enumerate(self.__nested_zips(gradebook)):
+                with gradebook.open(info) as nested_file:
+                    data = nested_file.read()
+                pending.append((info, executor.submit(_fix_nested_zip, data, name, index, self.task_id,
+                                                      self.task_file_extensions, self.TEMP_DIR)))
+                # The results are written in the order of the gradebook, with only a limited number
+                # of archives held in memory ahead of the one being written
+                while len(pending) > processes * 2:
+                    self.__write_fixed_zip(gradebook, out_f, *pending.popleft())
+            while pending:
+                self.__write_fixed_zip(gradebook, out_f, *pending.popleft())
+        os.replace(output + '.part', output)
+
+    def fix_zips(self, streaming=False, processes=None):
+        """Fix the nested zip archives in the gradebook, moving the task's files out of
+        sub-directories, and write the fixed gradebook to ``gradebook_<module>_<task>_fixed.zip``.
+        The nested archives are fixed in a pool of processes, each extracting into its own scratch
+        directory, and the fixed gradebook is assembled in the order of the original gradebook.
+
+        :param streaming: If ``True``, then the fixed gradebook is written straight from the original
+                          gradebook, without extracting it to disk. Nested archives that need no
+                          fixing and the files in the fixed archives keep their compression
+                          method.
+        :type streaming: ``boolean``
+        :param processes: The number of processes to use. Defaults to the number of CPUs.
+        :type processes: ``int``
+        :return: The status of each nested archive, which :meth:`report` formats as text
+        :rtype: ``list`` of :class:`~automarking.utils.ArchiveStatus`
+        """
+        processes = processes if processes is not None else os.cpu_count()
+        self.statuses = []
         self.__cleanup()
         self.__create_temp_directories()
-        self.__extract_gradebook()
-        self.__remove_old_attempts()
-        self.__compress_modified_gradebook()
-        self.__cleanup()
-        print('[Ultra Gradebook] Fixed Gradebook Submissions.')
+        try:
+            if streaming:
+                self.__fix_zips_streaming(processes)
+            else:
+                self.__extract_gradebook()
+                self.__process_submission(processes)
+                self.__compress_modified_gradebook()
+        finally:
+            self.__cleanup()
+        return self.statuses
+
+    def ultra_gradebook_submission_download_fix(self, policy='last'):
+        """Keep only one attempt of each student and write the fixed gradebook to
+        ``gradebook_<module>_<task>_fixed.zip``. The attempts are selected from the gradebook's
+        :class:`~automarking.core.GradebookIndex` and only the nested archives of the selected
+        attempts are copied, without extracting the gradebook. Students are identified by the user name
+        before ``_attempt_`` in the filename (see :meth:`~automarking.core.GradebookIndex.student`),
+        and nested archives that identify no student are copied unchanged.
+
+        :param policy: The attempt to keep: ``last`` (the newest), ``first`` or ``largest``. See
+                       :meth:`~automarking.core.GradebookIndex.select_attempt`.
+        :type policy: ``unicode``
+        :return: The status of each nested archive, which :meth:`report` formats as text
+        :rtype: ``list`` of :class:`~automarking.utils.ArchiveStatus`
+        """
+        self.statuses = []
+        output = os.path.expanduser(os.path.join(self.current_working_directory,
+                                                 'gradebook_{}_{}_fixed.zip'.format(self.module_code, self.task_id)))
+        with ZipFile(self.gradebook_path) as gradebook:
+            index = GradebookIndex.load(self.gradebook_path, gradebook=gradebook)
+            # Only attempts that contain a nested archive are considered
+            archives = GradebookIndex()
+            for studentnr, attempts in index.students.items():
+                for attempt, members in attempts.items():
+                    members = [member for member in members if member.filename.endswith('zip')]
+                    if members:
+                        archives.students.setdefault(studentnr, {})[attempt] = members
+            selected = set()
+            indexed = set()
+            for studentnr in archives.students:
+                selected.update(member.filename for member in archives.select_attempt(studentnr, policy)[1])
+                indexed.update(member.filename for member in archives.members(studentnr))
+            with ZipFile(output + '.part', 'w') as out_f:
+                for info, name in self.__nested_zips(gradebook):
+                    if info.filename in selected or info.filename not in indexed:
+                        copy_zip_member(gradebook, info, out_f, name)
+                        self.statuses.append(ArchiveStatus(name, ArchiveStatus.UNCHANGED))
+                    else:
+                        self.statuses.append(ArchiveStatus(name, ArchiveStatus.OLD_ATTEMPT))
+        os.replace(output + '.part', output)
+        return self.statuses
+
+    def report(self):
+        """Format the status of each nested archive processed by the last fix as text, followed by
+        the number of archives with each status."""
+        lines = []
+        counts = {}
+        for status in self.statuses:
+            lines.append('%-12s %s%s' % (status.status, status.name, ' (%s)' % status.message if status.message else ''))
+            counts[status.status] = counts.get(status.status, 0) + 1
+        lines.append(', '.join('%i %s' % (count, name) for name, count in sorted(counts.items())))
+        return '\n'.join(lines)
 
 # current_working_directory = os.path.dirname(os.path.realpath(__file__)) + '/'
 # GB = current_working_directory + 'gradebook.zip'
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Regression tests for running test processes with :func:`~automarking.tests.run_test`."""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from automarking.core import SubmissionPart, SubmissionSpec  # noqa: E402
+from automarking.tests import run_test, run_test_async  # noqa: E402
+
+
+class OutputLimitTest(unittest.TestCase):
+    """A test that is stopped at the output limit must never be scored as passed, even when the
+    process exits before it can be killed."""
+
+    RUNS = 30
+
+    def part(self):
+        return SubmissionPart(SubmissionSpec('test.sh', 'Test', r'.*'))
+
+    def test_runaway_output_is_not_passed(self):
+        for _ in range(self.RUNS):
+            part = self.part()
+            run_test('sh', ['-c', 'yes'], part, timeout=10, correct_points=4, attempt_points=2,
+                     limits={'output': 100000})
+            self.assertEqual(part.resources[-1]['exit_reason'], 'output-limit')
+            self.assertEqual(part.score, 2)
+
+    def test_runaway_output_is_not_passed_async(self):
+        for _ in range(self.RUNS):
+            part = self.part()
+            asyncio.run(run_test_async('sh', ['-c', 'yes'], part, timeout=10, correct_points=4, attempt_points=2,
+                                       limits={'output': 100000}))
+            self.assertEqual(part.resources[-1]['exit_reason'], 'output-limit')
+            self.assertEqual(part.score, 2)
+
+    def test_passing_test(self):
+        part = self.part()
+        run_test('sh', ['-c', 'exit 0'], part, timeout=10, correct_points=4, attempt_points=2)
+        self.assertEqual(part.resources[-1]['exit_reason'], 'exit')
+        self.assertEqual(part.score, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()